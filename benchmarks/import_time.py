@@ -0,0 +1,75 @@
+#!/usr/bin/python
+"""
+Import time benchmark.
+
+Measures the time of importing the symbolic part of the package in fresh
+interpreters, and checks that neither importing it nor deriving a
+canonical differential imports NumPy, SciPy or Matplotlib. Exits with
+status 1 if a budget is exceeded, so it can be run as a regression check:
+
+    python benchmarks/import_time.py [budget in ms]
+"""
+import os
+import subprocess
+import sys
+
+# Budget of the fastest of the runs, in milliseconds.
+BUDGET_MS = 50.0
+RUNS = 7
+
+MODULES = [
+    "matrix_calculus",
+    "matrix_calculus.matrix_massage",
+    "matrix_calculus.show_latex",
+]
+
+HEAVY_MODULES = ["numpy", "scipy", "matplotlib"]
+
+DERIVATION = """
+from matrix_calculus import *
+from matrix_calculus.matrix_massage import canonical_differential
+canonical_differential("Tr((Y-D*X)'*(Y-D*X))", "X")
+"""
+
+
+def run(code):
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [root] + os.environ.get("PYTHONPATH", "").split(os.pathsep)))
+    return subprocess.check_output([sys.executable, "-c", code], env=env).decode().strip()
+
+
+def import_time_ms(module):
+    code = ("import time\n"
+            "start = time.perf_counter()\n"
+            "import {}\n"
+            "print((time.perf_counter() - start) * 1000)").format(module)
+    return min(float(run(code)) for _ in range(RUNS))
+
+
+def loaded_heavy_modules(code):
+    code += "\nimport sys\nprint(' '.join(m for m in {} if m in sys.modules))".format(
+        HEAVY_MODULES)
+    return run(code).split()
+
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET_MS
+    ok = True
+    for module in MODULES:
+        ms = import_time_ms(module)
+        heavy = loaded_heavy_modules("import {}".format(module))
+        print("{:<35} {:6.1f} ms (budget {:.1f} ms){}".format(
+            module, ms, budget, "" if len(heavy) == 0 else ", imports " + ", ".join(heavy)))
+        ok = ok and ms <= budget and len(heavy) == 0
+    heavy = loaded_heavy_modules(DERIVATION)
+    print("{:<35} {}".format("symbolic derivation", "imports " + ", ".join(heavy)
+                             if len(heavy) > 0 else "ok"))
+    ok = ok and len(heavy) == 0
+    if not ok:
+        print("FAILED")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+"""
+Memory benchmark of expression nodes.
+
+Builds a large objective and its second differential, and reports the
+bytes per distinct node: the size of the node objects themselves, and
+all memory traced while building them, including the interning table.
+Each checkout is measured in a fresh interpreter, so that the layout of
+an older version can be compared with the current one, e.g.
+
+    git worktree add /tmp/before HEAD~1
+    python benchmarks/node_memory.py [terms] /tmp/before
+"""
+import os
+import subprocess
+import sys
+
+TERMS = 1000
+
+MEASURE = """
+import gc
+import sys
+import tracemalloc
+
+tracemalloc.start()
+from matrix_calculus import *
+
+def object_bytes(e):
+    size = sys.getsizeof(e)
+    if hasattr(e, "__dict__"):
+        size += sys.getsizeof(e.__dict__)
+    if not isinstance(e.children, tuple) or len(e.children) > 0:
+        size += sys.getsizeof(e.children)
+    return size
+
+gc.collect()
+start = tracemalloc.get_traced_memory()[0]
+X = Variable("X")
+f = Tr(X.T*X)
+for i in range({terms}):
+    A = Variable("A{{}}".format(i))
+    B = Variable("B{{}}".format(i))
+    f = f + Tr(A*X*B*X.T) + Scalar(i)*Tr(A.T*X)
+ddf = d(d(f, "X"), "X")
+gc.collect()
+traced = tracemalloc.get_traced_memory()[0] - start
+
+seen = set()
+nodes = []
+todo = [f, ddf]
+while len(todo) > 0:
+    e = todo.pop()
+    if id(e) not in seen:
+        seen.add(id(e))
+        nodes.append(e)
+        todo.extend(e.children)
+print(len(nodes), sum(object_bytes(e) for e in nodes) / len(nodes), traced / len(nodes))
+"""
+
+
+def measure(root, terms):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [root] + os.environ.get("PYTHONPATH", "").split(os.pathsep)))
+    out = subprocess.check_output([sys.executable, "-c", MEASURE.format(terms=terms)],
+                                  env=env, cwd=root).decode().split()
+    return int(out[0]), float(out[1]), float(out[2])
+
+
+def main():
+    args = sys.argv[1:]
+    terms = int(args.pop(0)) if len(args) > 0 and args[0].isdigit() else TERMS
+    roots = [os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")] + args
+    print("{:<40} {:>8} {:>14} {:>14}".format("checkout", "nodes", "object B/node", "traced B/node"))
+    for root in roots:
+        nodes, object_bytes, traced = measure(os.path.abspath(root), terms)
+        print("{:<40} {:>8} {:>14.1f} {:>14.1f}".format(
+            os.path.abspath(root), nodes, object_bytes, traced))
+
+
+if __name__ == "__main__":
+    main()
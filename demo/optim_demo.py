@@ -37,7 +37,7 @@ def main():
     print("Jacobian:")
     print(dX)
 
-    # The derivative is 0.5Tr((Dd(X))'(Y-DX)+(Y-DX)'Dd(X)),
+    # The derivative is 0.5Tr((-1Dd(X))'(Y-DX)+-1(Y-DX)'Dd(X)),
     # which is correct, but we need the canonical form
     # of the derivative in order to to gradient descent.
     # We can get this form by using massage2canonical.
@@ -45,7 +45,8 @@ def main():
     print("Jacobian (canonical):")
     print(dX)
 
-    # The (canonical) derivative is 0.5Tr(((D'(Y-DX))'+(Y-DX)'D)d(X)).
+    # The (canonical) derivative is -1Tr((Y-DX)'Dd(X)),
+    # so the gradient is -D'(Y-DX).
     # We can solve this using L-BFGS
     from scipy.optimize import fmin_l_bfgs_b
     X0 = np.random.random((p, n))
@@ -56,21 +57,34 @@ def main():
 
     def fp_true(x):
         X = x.reshape((p, n))
-        return 0.5*((D.T.dot(Y-D.dot(X))).T+(Y-D.dot(X)).T.dot(D)).ravel()
-    from matrix_calculus.func import expr2func
+        return -D.T.dot(Y-D.dot(X)).ravel()
+    from matrix_calculus.func import expr2value_and_grad
     const_dict = {'Y': Y, 'D': D}
-    f = expr2func(expr, wrt, const_dict, wrt_shape=(p, n))
-    fp = expr2func(dX, wrt, const_dict, wrt_shape=(
-        p, n), res_shape=(-1), is_grad=True)
-    print(np.linalg.norm(f(X0) - f_true(X0)))
-    print(np.linalg.norm(fp(X0) - fp_true(X0)))
+    # The value and the gradient are computed together,
+    # sharing the residual Y-DX.
+    fg = expr2value_and_grad(expr, dX, wrt, const_dict, wrt_shape=(p, n))
+    f0, fp0 = fg(X0.ravel())
+    print(np.linalg.norm(f0 - f_true(X0)))
+    print(np.linalg.norm(fp0 - fp_true(X0)))
 
-    x, min_val, d = fmin_l_bfgs_b(f, X0, fp)
+    x, min_val, d = fmin_l_bfgs_b(fg, X0)
     X = x.reshape((p, n))
     for k in ['warnflag', 'funcalls', 'nit', 'grad']:
         print("{}: {}".format(k, d[k]))
     print("x: {}".format(x))
 
+    # Newton-CG only needs products of the Hessian with vectors,
+    # which are computed from the second differential.
+    from scipy.optimize import minimize
+    from matrix_calculus.func import expr2hvp
+    from matrix_calculus.matrix_massage import canonical_differential
+    ddX = canonical_differential(expr, wrt, hessian=True)
+    print("Second differential (canonical):")
+    print(ddX)
+    hvp = expr2hvp(ddX, wrt, const_dict, wrt_shape=(p, n))
+    res = minimize(fg, X0.ravel(), jac=True, hessp=hvp, method="Newton-CG")
+    print("Newton-CG: {} iterations, f = {}".format(res.nit, res.fun))
+
 
 if __name__ == "__main__":
     main()
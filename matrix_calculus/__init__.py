@@ -1,2 +1,4 @@
 
 from matrix_calculus.base import *
+from matrix_calculus.cache import *
+from matrix_calculus.matrix_expr import *
@@ -1,5 +1,7 @@
+import warnings
+
+from matrix_calculus.cache import LRUCache
 from matrix_calculus.matrix_expr import *
-import copy
 """"
 A module for doing simple matrix calculus in Python.
 
@@ -32,26 +34,136 @@ Source: T.P. Minka, "Old and New Matrix Algebra Useful for Statistics", 2000.
 
 """
 
+__all__ = ["DiffCache", "d", "d_all"]
+
+
+class DiffCache(LRUCache):
+    """
+    Bounded LRU cache of differentials, keyed on (expr, wrt).
+
+    As expression nodes are hash-consed, structurally identical
+    subexpressions are the same object, and are looked up by id().
+    Each entry keeps its expression alive, so the id stays valid
+    for as long as the entry is in the cache.
+
+    A cache can be passed to several calls of d() in order to
+    share differentials between them.
+
+    Keyword args:
+      - maxsize: Maximum number of entries. The least recently used
+          entry is evicted when this is exceeded.
+    """
+
+    def get_differential(self, expr, wrt):
+        entry = self.get((id(expr), id(wrt)))
+        if entry is None:
+            return None
+        return entry[2]
+
+    def put_differential(self, expr, wrt, dexpr):
+        self.put((id(expr), id(wrt)), (expr, wrt, dexpr))
+
 
-def d(expr, wrt, hessian=False):
+def d(expr, wrt, hessian=False, cache=None):
     """
     Differential operator.
+
+    Keyword args:
+      - cache: DiffCache to use. By default, a new cache is used for
+          each call, so repeated subexpressions are only differentiated once.
     """
     if type(expr) == str:
-        expr = Expr().from_string(expr)
+        expr = Expr.from_string(expr)
     if type(wrt) == str:
         wrt = Variable(wrt)
+    if cache is None:
+        cache = DiffCache()
     if hessian:
         # 1. Calculate differential.
-        expr = d(expr, wrt)
+        expr = d(expr, wrt, cache=cache)
         # 2. Calculate differential of differential.
-        expr.make_dx_constant(wrt)
-        return d(expr, wrt)
+        expr = expr.make_dx_constant(wrt)
+        return d(expr, wrt, cache=cache)
+
+    dexpr = cache.get_differential(expr, wrt)
+    if dexpr is not None:
+        return dexpr
+    # Differentials of the nodes of expr. They are also kept here,
+    # as the cache may evict them before they are used.
+    mem = {}
+    # Nodes that have been looked up in the cache. Each node is looked up
+    # once, and a later use of it counts as a hit, as in the recursive d().
+    seen = {expr}
+    expanded = set()
+    todo = [expr]
+    while len(todo) > 0:
+        e = todo[-1]
+        if e in mem:
+            todo.pop()
+            continue
+        if e not in expanded:
+            expanded.add(e)
+            pending = []
+            for c in _differentiated_children(e):
+                if c in seen:
+                    cache.hits += 1
+                    if c not in mem:
+                        pending.append(c)
+                    continue
+                seen.add(c)
+                dexpr = cache.get_differential(c, wrt)
+                if dexpr is None:
+                    pending.append(c)
+                else:
+                    mem[c] = dexpr
+            if len(pending) > 0:
+                todo.extend(reversed(pending))
+                continue
+        todo.pop()
+        dexpr = _d_node(e, wrt, mem)
+        cache.put_differential(e, wrt, dexpr)
+        mem[e] = dexpr
+    return mem[expr]
+
+
+def _differentiated_children(expr):
+    """
+    The children of expr whose differentials are needed for that of expr.
+    """
+    if isinstance(expr, ScalarMulExpr):
+        # The scalar factor is taken as a constant.
+        return expr.children[1:]
+    elif isinstance(expr, ProductExpr):
+        return [c for c in expr.children if not _is_scalar_factor(c)]
+    elif isinstance(expr, (AddExpr, SubExpr, SumExpr, TraceExpr, MatMulExpr, InverseExpr,
+                           StarExpr)):
+        return expr.children
+    return ()
+
+
+def _is_scalar_factor(expr):
+    # Scalar factors of products are taken as constants, as in d(aX).
+    return isinstance(expr, (Scalar, ScalarVariable))
+
+
+def _d_product(factors, dfactors):
+    """
+    d(XYZ) = (dX)YZ + X(dY)Z + XYdZ, given the
+    differentials of the factors that are not constant.
+    """
+    terms = []
+    for i, f in enumerate(factors):
+        if f in dfactors:
+            terms.append(make_product(factors[:i] + (dfactors[f],) + factors[i + 1:]))
+    return make_sum((1,) * len(terms), terms)
 
-    expr = copy.deepcopy(expr)
-    prev_expr = copy.deepcopy(expr)
 
-    if (isinstance(expr, Variable) and expr.name != wrt.name) or isinstance(expr, Scalar):
+def _d_node(expr, wrt, mem):
+    """
+    Differential of expr, given those of its children in mem.
+    """
+    if (isinstance(expr, Variable) and expr.name != wrt.name) or \
+            isinstance(expr, (Scalar, NullExpr)):
         # dA = 0
         expr = NullExpr()
         #expr = Scalar(0)
@@ -63,35 +175,150 @@ def d(expr, wrt, hessian=False):
         expr = NullExpr()
     elif isinstance(expr, ScalarMulExpr):
         # d(aX) = adX
-        expr = expr.children[0]*d(expr.children[1], wrt)
+        expr = expr.children[0]*mem[expr.children[1]]
     elif isinstance(expr, AddExpr):
         # d(X+Y) = dX + dY
-        expr = d(expr.children[0], wrt) + d(expr.children[1], wrt)
+        expr = mem[expr.children[0]] + mem[expr.children[1]]
     elif isinstance(expr, SubExpr):
         # d(X+Y) = dX - dY
-        expr = d(expr.children[0], wrt) - d(expr.children[1], wrt)
+        expr = mem[expr.children[0]] - mem[expr.children[1]]
+    elif isinstance(expr, SumExpr):
+        # d(aX+bY) = adX + bdY
+        expr = make_sum(expr.coefficients, [mem[c] for c in expr.children])
+    elif isinstance(expr, ProductExpr):
+        expr = _d_product(expr.children, dict(
+            (c, mem[c]) for c in expr.children if not _is_scalar_factor(c)))
     elif isinstance(expr, TraceExpr):
         # d(tr(X)) = tr(dX)
-        expr = TraceExpr(d(expr.children[0], wrt))
+        expr = TraceExpr(mem[expr.children[0]])
     elif isinstance(expr, MatMulExpr):
         # d(XY) = (dX)Y + XdY
-        expr = d(expr.children[0], wrt)*expr.children[1] + \
-            expr.children[0]*d(expr.children[1], wrt)
+        expr = mem[expr.children[0]]*expr.children[1] + \
+            expr.children[0]*mem[expr.children[1]]
     elif isinstance(expr, InverseExpr):
         # d(X.I) = -X.I(dX)X.I
-        expr = -InverseExpr(expr.children[0]) * d(expr.children[0], wrt) * \
+        expr = -InverseExpr(expr.children[0]) * mem[expr.children[0]] * \
                 InverseExpr(expr.children[0])
     elif isinstance(expr, StarExpr):
         # dX* = (dX)*
-        expr = copy.copy(expr)
-        expr.children[0] = d(expr.children[0], wrt)
-        if isinstance(expr.children[0], NullExpr):
+        dchild = mem[expr.children[0]]
+        if isinstance(dchild, NullExpr):
             expr = NullExpr()
+        else:
+            expr = expr.with_children([dchild])
     else:
         # In this case, we do not know how to go further
         expr = DifferentialExpr(expr, wrt)
-        print("Warning: Don't know how to process {}".format(expr))
+        warnings.warn("Don't know how to process {}".format(expr))
+    return expr
 
-    # print "d{} -> {}".format(prev_expr,expr)
 
-    return expr
+def d_all(expr, wrts=None):
+    """
+    Differential operator with respect to several variables at once.
+
+    Makes one pass over expr, computing for each subexpression its
+    differential with respect to every variable it depends on, using
+    the same rules as d(). Subexpressions that occur several times
+    are only differentiated once.
+
+    Keyword args:
+      - wrts: Variables (or names) to differentiate with respect to.
+          Defaults to all variables in expr, in order of appearance.
+
+    Returns a dict mapping each variable to the differential of expr
+    with respect to it, the same as d(expr, variable) up to zero terms.
+    """
+    if type(expr) == str:
+        expr = Expr.from_string(expr)
+    if wrts is None:
+        wrts = []
+        seen = set()
+        todo = [expr]
+        while len(todo) > 0:
+            e = todo.pop()
+            if e in seen:
+                continue
+            seen.add(e)
+            if isinstance(e, Variable) and e not in wrts:
+                wrts.append(e)
+            todo.extend(reversed(e.children))
+    wrts = [Variable(w) if type(w) == str else w for w in wrts]
+    names = dict((w.name, w) for w in wrts)
+
+    # node -> dict mapping variables to the nonzero differentials of the node.
+    mem = {}
+    todo = [expr]
+    while len(todo) > 0:
+        e = todo[-1]
+        if e in mem:
+            todo.pop()
+            continue
+        pending = [c for c in _differentiated_children(e) if c not in mem]
+        if len(pending) > 0:
+            todo.extend(reversed(pending))
+            continue
+        todo.pop()
+        mem[e] = _d_all_node(e, mem, wrts, names)
+    dexprs = mem[expr]
+    return dict((w, dexprs.get(w, NullExpr())) for w in wrts)
+
+
+def _d_all_node(expr, mem, wrts, names):
+    """
+    Differentials of expr with respect to the variables,
+    given those of its children in mem.
+    """
+    def dchild(i, wrt):
+        return mem[expr.children[i]].get(wrt, NullExpr())
+
+    def variables(*indices):
+        found = []
+        for i in indices:
+            found.extend(w for w in mem[expr.children[i]] if w not in found)
+        return found
+
+    if isinstance(expr, Variable):
+        # dX, or dA = 0
+        wrt = names.get(expr.name)
+        return {wrt: DifferentialExpr(expr, wrt)} if wrt is not None else {}
+    elif isinstance(expr, (Scalar, DifferentialExpr, NullExpr)):
+        # dA = 0, d(dX) = 0
+        return {}
+    elif isinstance(expr, ScalarMulExpr):
+        # d(aX) = adX
+        dexprs = dict((w, expr.children[0]*dchild(1, w)) for w in variables(1))
+    elif isinstance(expr, AddExpr):
+        # d(X+Y) = dX + dY
+        dexprs = dict((w, dchild(0, w) + dchild(1, w)) for w in variables(0, 1))
+    elif isinstance(expr, SubExpr):
+        # d(X-Y) = dX - dY
+        dexprs = dict((w, dchild(0, w) - dchild(1, w)) for w in variables(0, 1))
+    elif isinstance(expr, SumExpr):
+        # d(aX+bY) = adX + bdY
+        indices = range(len(expr.children))
+        dexprs = dict((w, make_sum(expr.coefficients, [dchild(i, w) for i in indices]))
+                      for w in variables(*indices))
+    elif isinstance(expr, ProductExpr):
+        indices = [i for i, c in enumerate(expr.children) if not _is_scalar_factor(c)]
+        dexprs = dict((w, _d_product(expr.children, dict(
+            (expr.children[i], dchild(i, w)) for i in indices))) for w in variables(*indices))
+    elif isinstance(expr, TraceExpr):
+        # d(tr(X)) = tr(dX)
+        dexprs = dict((w, TraceExpr(dchild(0, w))) for w in variables(0))
+    elif isinstance(expr, MatMulExpr):
+        # d(XY) = (dX)Y + XdY
+        dexprs = dict((w, dchild(0, w)*expr.children[1] + expr.children[0]*dchild(1, w))
+                      for w in variables(0, 1))
+    elif isinstance(expr, InverseExpr):
+        # d(X.I) = -X.I(dX)X.I
+        dexprs = dict((w, -InverseExpr(expr.children[0]) * dchild(0, w) *
+                       InverseExpr(expr.children[0])) for w in variables(0))
+    elif isinstance(expr, StarExpr):
+        # dX* = (dX)*
+        dexprs = dict((w, expr.with_children([dchild(0, w)])) for w in variables(0))
+    else:
+        # In this case, we do not know how to go further
+        dexprs = dict((w, DifferentialExpr(expr, w)) for w in wrts)
+        warnings.warn("Don't know how to process {}".format(expr))
+    return dict((w, dexpr) for w, dexpr in dexprs.items() if not isinstance(dexpr, NullExpr))
@@ -0,0 +1,212 @@
+"""
+Caches for derivation results.
+
+@author Tommi Kerola
+
+"""
+
+import collections
+import os
+
+from matrix_calculus.lazy import LazyModule
+from matrix_calculus.matrix_expr import Expr
+
+__all__ = ["LRUCache", "CanonicalCache", "DiskCache", "fingerprint"]
+
+# Only used by DiskCache and fingerprint, so they are imported on first use.
+hashlib = LazyModule("hashlib")
+pickle = LazyModule("pickle")
+tempfile = LazyModule("tempfile")
+
+
+class LRUCache(object):
+    """
+    Bounded cache that evicts the least recently used entry.
+
+    Keyword args:
+      - maxsize: Maximum number of entries.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CanonicalCache(LRUCache):
+    """
+    Cache of canonical forms, keyed on (rule set, expression).
+
+    Pass the same cache to several calls of massage2canonical in order
+    to reuse the canonical forms of subexpressions between them.
+    """
+
+    def get_canonical(self, rules, expr):
+        return self.get((rules, expr))
+
+    def put_canonical(self, rules, expr, canonical_expr):
+        self.put((rules, expr), canonical_expr)
+
+
+class DiskCache(object):
+    """
+    Cache of derivation results in a local directory, which can be
+    shared between processes.
+
+    Each entry is pickled to its own file. Entries are written to a
+    temporary file that is then renamed into place, so concurrent readers
+    never see a partially written entry. When the total size of the
+    entries exceeds max_bytes, the least recently used entries are removed.
+
+    Keyword args:
+      - directory: Directory to keep the entries in. Created if missing.
+      - max_bytes: Maximum total size of the entries.
+    """
+
+    suffix = ".pkl"
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except OSError:
+            self.misses += 1
+            return default
+        except (EOFError, ValueError, pickle.UnpicklingError):
+            # A truncated entry, or an expression in an older format,
+            # see serialize.loads. It would never be read, so remove it.
+            self.misses += 1
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return default
+        try:
+            # Mark the entry as recently used.
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until
+        the total size is at most max_bytes.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # Removed by another process.
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total_bytes = sum(size for _, size, _ in entries)
+        entries.sort()
+        for _, size, path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_bytes -= size
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(self.suffix):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+        self.hits = 0
+        self.misses = 0
+
+
+def fingerprint(expr, digests=None):
+    """
+    Returns a hex digest of the structure of expr.
+
+    Unlike hash(expr), the digest is the same in every process, so it
+    can be used as a key for persistent caches.
+
+    Keyword args:
+      - digests: Dict mapping id(node) -> digest, which is filled in for
+          every node of expr. It can be passed to several calls on
+          expressions that share subtrees, which are then digested once.
+          The nodes must stay alive for as long as the dict is used.
+    """
+    if digests is None:
+        digests = {}
+    todo = [expr]
+    while len(todo) > 0:
+        e = todo[-1]
+        if id(e) in digests:
+            todo.pop()
+            continue
+        args = e._args()
+        pending = [a for a in args if isinstance(a, Expr) and id(a) not in digests]
+        if len(pending) > 0:
+            todo.extend(pending)
+            continue
+        todo.pop()
+        h = hashlib.sha256(type(e).__name__.encode())
+        for a in args:
+            if isinstance(a, Expr):
+                h.update(b"e" + digests[id(a)])
+            else:
+                value = repr((type(a).__name__, a)).encode()
+                h.update(b"v" + str(len(value)).encode() + b":" + value)
+        digests[id(e)] = h.digest()
+    return digests[id(expr)].hex()
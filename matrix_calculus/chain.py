@@ -0,0 +1,239 @@
+"""
+Ordering of matrix chain products.
+
+A product A1 A2 ... An can be computed in any association, but the
+cost depends a lot on the order. E.g. for a tall-skinny X of size
+n x p and a vector v, (X'X)v takes about np^2 multiplications whereas
+X'(Xv) takes about 2np. The order that takes the fewest scalar
+multiplications is found by dynamic programming on the operand shapes.
+
+@author Tommi Kerola
+
+"""
+
+import functools
+
+import numpy as np
+
+from matrix_calculus.factorization import Factorization, dense, dot, is_batch_scalar
+from matrix_calculus.sparse import issparse, sparse_trace_dot, trace
+
+# Marks the multiplication of the two topmost values in a plan.
+MULTIPLY = -1
+
+# Longer chains are multiplied from left to right,
+# since finding the best order takes cubic time.
+MAX_CHAIN_LENGTH = 64
+
+
+def _left_to_right(n):
+    plan = [0]
+    for i in range(1, n):
+        plan.extend((i, MULTIPLY))
+    return plan
+
+
+@functools.lru_cache(maxsize=1024)
+def chain_plan(shapes):
+    """
+    Returns the order of multiplying a chain of matrices of the given
+    shapes, as a postfix program: a list of operand indices, and
+    MULTIPLY for multiplying the two topmost intermediate results.
+
+    Vectors are allowed at the ends of the chain. Chains that are too
+    long or whose shapes do not match are multiplied from left to right.
+    """
+    n = len(shapes)
+    dims = []
+    for i, shape in enumerate(shapes):
+        if len(shape) == 2:
+            rows, cols = shape
+        elif len(shape) == 1 and i == 0:
+            rows, cols = 1, shape[0]
+        elif len(shape) == 1 and i == n - 1:
+            rows, cols = shape[0], 1
+        else:
+            return _left_to_right(n)
+        if i == 0:
+            dims.append(rows)
+        elif dims[-1] != rows:
+            return _left_to_right(n)
+        dims.append(cols)
+    if n > MAX_CHAIN_LENGTH:
+        return _left_to_right(n)
+
+    cost, split = _chain_tables(dims, n)
+    return _plan(split, 0, n - 1)
+
+
+def _chain_tables(dims, max_length):
+    """
+    Returns the tables cost and split for the chain of matrices of
+    shapes (dims[i], dims[i + 1]), for all subchains of at most
+    max_length matrices. cost[i][j] is the number of multiplications
+    in the product of matrices i..j, which is best split after
+    matrix split[i][j].
+    """
+    n = len(dims) - 1
+    cost = [[0] * n for _ in range(n)]
+    split = [[0] * n for _ in range(n)]
+    for length in range(2, max_length + 1):
+        for i in range(n - length + 1):
+            j = i + length - 1
+            best = None
+            for k in range(i, j):
+                c = cost[i][k] + cost[k + 1][j] + dims[i] * dims[k + 1] * dims[j + 1]
+                if best is None or c < best:
+                    best = c
+                    split[i][j] = k
+            cost[i][j] = best
+    return cost, split
+
+
+def _plan(split, first, last, index=lambda i: i):
+    """
+    Returns the postfix program for the product
+    of matrices first..last given the split table.
+    """
+    plan = []
+    todo = [(first, last)]
+    while len(todo) > 0:
+        item = todo.pop()
+        if item == MULTIPLY:
+            plan.append(MULTIPLY)
+            continue
+        i, j = item
+        if i == j:
+            plan.append(index(i))
+            continue
+        k = split[i][j]
+        todo.extend((MULTIPLY, (k + 1, j), (i, k)))
+    return plan
+
+
+@functools.lru_cache(maxsize=1024)
+def trace_plan(shapes):
+    """
+    Returns the order of computing the trace of a chain of matrices of
+    the given shapes, or None if the chain is not square.
+
+    As the trace is invariant under cyclic rotations, Tr(A1...An) is
+    computed as Tr(LR) = sum(L * R') for the rotation and split into
+    products L and R that take the fewest multiplications. The result
+    is a pair of postfix programs for L and R, as in chain_plan.
+    """
+    n = len(shapes)
+    if n > MAX_CHAIN_LENGTH or any(len(shape) != 2 for shape in shapes):
+        return None
+    dims = [shape[0] for shape in shapes] + [shapes[0][0]]
+    if any(shapes[i][1] != dims[i + 1] for i in range(n)):
+        return None
+    if n == 1:
+        return [0], None
+
+    # Subchains of a rotation are windows of the doubled chain.
+    doubled = dims[:-1] * 2 + [dims[0]]
+    cost, split = _chain_tables(doubled, n - 1)
+    best = None
+    for r in range(n):
+        for j in range(r + 1, r + n):
+            c = cost[r][j - 1] + cost[j][r + n - 1] + doubled[r] * doubled[j]
+            if best is None or c < best[0]:
+                best = (c, r, j)
+    _, r, j = best
+    index = lambda i: i % n
+    return _plan(split, r, j - 1, index), _plan(split, j, r + n - 1, index)
+
+
+def _run(plan, matrices, batched):
+    stack = []
+    for step in plan:
+        if step == MULTIPLY:
+            right = stack.pop()
+            stack.append(dot(stack.pop(), right, batched))
+        else:
+            stack.append(matrices[step])
+    return stack[0]
+
+
+def _split_scalars(values, batched):
+    scale = 1
+    matrices = []
+    for v in values:
+        if np.ndim(v) == 0 or batched and is_batch_scalar(v):
+            scale = scale * v
+        else:
+            matrices.append(v)
+    return scale, matrices
+
+
+def _shapes(matrices):
+    # Stacks of matrices are planned by the shape of one matrix.
+    return tuple(np.shape(m)[-2:] for m in matrices)
+
+
+def trace_dot(a, b, batched=False):
+    """
+    Returns Tr(ab) without computing the product ab.
+    With batched set, a and b can be stacks of matrices.
+    """
+    if isinstance(a, Factorization) or isinstance(b, Factorization):
+        return batch_trace(dot(a, b), batched)
+    elif issparse(a) or issparse(b):
+        return sparse_trace_dot(a, b)
+    elif batched:
+        return np.einsum("...ij,...ji->...", a, b)
+    return np.einsum("ij,ji->", a, b)
+
+
+def batch_trace(a, batched=False):
+    """
+    np.trace, of each matrix in a stack if batched is set.
+    """
+    if batched and np.ndim(a) > 2:
+        return np.trace(a, axis1=-2, axis2=-1)
+    return trace(a)
+
+
+def multiply_chain(values, batched=False):
+    """
+    Computes the product of values like np.dot from left to right,
+    in the order given by chain_plan. Scalar values are
+    multiplied into the result at the end, and products with a
+    Factorization are computed as solves.
+
+    With batched set, the values can be stacks of matrices of shape
+    (..., m, n), or of scalars of shape (..., 1, 1), which are
+    multiplied like np.matmul.
+    """
+    scale, matrices = _split_scalars(values, batched)
+    if len(matrices) == 0:
+        return scale
+    result = dense(_run(chain_plan(_shapes(matrices)), matrices, batched))
+    if batched or scale != 1:
+        result = scale * result
+    return result
+
+
+def trace_chain(values, batched=False):
+    """
+    Computes the trace of the product of values, in the order given
+    by trace_plan, so that the full product is never formed.
+
+    With batched set, the values are as in multiply_chain, and
+    the traces are returned as a stack of scalars of shape (..., 1, 1).
+    """
+    scale, matrices = _split_scalars(values, batched)
+    if len(matrices) == 0:
+        return scale
+    plan = trace_plan(_shapes(matrices))
+    if plan is None:
+        result = batch_trace(multiply_chain(matrices, batched), batched)
+    elif plan[1] is None:
+        result = batch_trace(dense(matrices[0]), batched)
+    else:
+        result = trace_dot(_run(plan[0], matrices, batched),
+                           _run(plan[1], matrices, batched), batched)
+    if batched and np.ndim(result) > 0:
+        result = result[..., np.newaxis, np.newaxis]
+    return scale * result
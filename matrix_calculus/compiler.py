@@ -0,0 +1,571 @@
+"""
+Compiles matrix expressions to flat NumPy functions.
+
+An expression is lowered once to a Program: a linear sequence of NumPy
+operations on numbered values. Subtrees that do not depend on the wrt
+variable are evaluated at compile time, with the constants taken from
+const_dict. The program is then turned into Python source and compiled
+to a function of x, so that calling it costs little more than the
+NumPy operations themselves.
+
+Optionally, the intermediate arrays are written with out= into buffers
+of a workspace that is allocated once per compiled function. Buffers are
+shared between intermediates whose lifetimes do not overlap. Programs are
+cached, but each function gets a workspace of its own.
+
+@author Tommi Kerola
+
+"""
+
+import operator
+
+import numpy as np
+
+from matrix_calculus.cache import LRUCache
+from matrix_calculus.chain import MULTIPLY, chain_plan, trace_dot, trace_plan
+from matrix_calculus.factorization import Factorization, dense, dot, factorize
+from matrix_calculus import sparse
+from matrix_calculus.matrix_expr import *
+
+
+def broadcast_shape(a, b):
+    return np.broadcast_shapes(a, b)
+
+
+def dot_shape(a, b):
+    # np.dot sums over the last axis of a and the first axis of b,
+    # if they have at most two dimensions, e.g. (n, k) (k,) -> (n,).
+    if len(a) == 0:
+        return b
+    elif len(b) == 0:
+        return a
+    elif len(a) <= 2 and len(b) <= 2:
+        if a[-1] != b[0]:
+            raise ValueError("Shapes {} and {} are not aligned.".format(a, b))
+        return a[:-1] + b[1:]
+    return None
+
+
+def trace_shape(a):
+    return a[2:]
+
+
+def transpose_shape(a):
+    return a[::-1]
+
+
+def same_shape(a):
+    return a
+
+
+# Operation name -> (source template, function, shape of the result).
+OPS = {
+    "add": ("_add({0}, {1})", sparse.add, broadcast_shape),
+    "sub": ("_subtract({0}, {1})", sparse.subtract, broadcast_shape),
+    "dot": ("_dot({0}, {1})", dot, dot_shape),
+    "mul": ("{0} * {1}", operator.mul, broadcast_shape),
+    "trace": ("_trace({0})", sparse.trace, trace_shape),
+    "trace_dot": ("_trace_dot({0}, {1})", trace_dot, lambda a, b: ()),
+    "transpose": ("_transpose({0})", sparse.transpose, transpose_shape),
+    "factorize": ("_factorize({0})", factorize, same_shape),
+    "dense": ("_dense({0})", dense, same_shape),
+}
+
+# Operations that can write into a buffer, with the function to call with out=.
+OUT_OPS = {
+    "add": np.add,
+    "sub": np.subtract,
+    "mul": np.multiply,
+    "dot": np.matmul,
+}
+
+# Alignment of the buffers in a workspace, in bytes.
+ALIGNMENT = 64
+
+_NAMESPACE = {
+    "_add": sparse.add,
+    "_subtract": sparse.subtract,
+    "_dot": dot,
+    "_trace": sparse.trace,
+    "_trace_dot": trace_dot,
+    "_transpose": sparse.transpose,
+    "_factorize": factorize,
+    "_dense": dense,
+}
+_NAMESPACE.update(("_out_" + op, f) for op, f in OUT_OPS.items())
+
+
+class Program(object):
+    """
+    A linear sequence of operations that evaluates an expression.
+
+    Values are numbered. Value 0 is the input x, constants are
+    held in the constants dict, and every other value is the result of
+    one instruction (out, op, args), where op is a key of OPS and args
+    are the numbers of the input values.
+
+    The shapes of the values are tracked where they are known, and
+    the dtypes of the values that are known to be dense ndarrays.
+
+    Keyword args:
+      - x_shape: Shape of x, if known.
+      - x_dtype: dtype of x, if x is known to be an ndarray.
+    """
+
+    def __init__(self, x_shape=None, x_dtype=None):
+        self.constants = {}
+        self.instructions = []
+        self.outputs = []
+        self.num_values = 1
+        self.shapes = {}
+        self.dtypes = {}
+        self.factorizations = set()
+        # (op, args) -> value, so that repeated operations,
+        # e.g. in overlapping chains of products, are computed once.
+        self.computed = {}
+        # workspace -> (code, buffers, report), see to_function.
+        self.code = {}
+        if x_shape is not None:
+            self.shapes[0] = tuple(x_shape)
+        if x_dtype is not None:
+            self.dtypes[0] = np.dtype(x_dtype)
+
+    def new_value(self):
+        self.num_values += 1
+        return self.num_values - 1
+
+    def add_constant(self, value):
+        v = self.new_value()
+        self.constants[v] = value
+        self.shapes[v] = np.shape(value)
+        if isinstance(value, np.ndarray):
+            self.dtypes[v] = value.dtype
+        return v
+
+    def add_instruction(self, op, args):
+        if all(a in self.constants for a in args):
+            # Fold operations on constants at compile time.
+            return self.add_constant(OPS[op][1](*[self.constants[a] for a in args]))
+        if (op, tuple(args)) in self.computed:
+            return self.computed[op, tuple(args)]
+        v = self.new_value()
+        self.computed[op, tuple(args)] = v
+        self.instructions.append((v, op, tuple(args)))
+        if op == "factorize":
+            self.factorizations.add(v)
+        if all(a in self.shapes for a in args):
+            try:
+                shape = OPS[op][2](*[self.shapes[a] for a in args])
+            except ValueError:
+                # Let the error surface when the program is run.
+                shape = None
+            if shape is not None:
+                self.shapes[v] = shape
+        if op == "transpose" and args[0] in self.dtypes:
+            self.dtypes[v] = self.dtypes[args[0]]
+        elif op in OUT_OPS and len(self.shapes.get(v, ())) > 0 and \
+                all(a in self.dtypes or np.ndim(self.constants.get(a)) == 0 and
+                    a in self.constants for a in args) and \
+                (op != "dot" or all(a in self.dtypes for a in args)):
+            # Scalar constants take part by value, so that they
+            # do not promote the dtype of an array.
+            self.dtypes[v] = np.result_type(
+                *[self.dtypes[a] if a in self.dtypes else self.constants[a] for a in args])
+        return v
+
+    def _split_scalars(self, args):
+        scale = []
+        matrices = []
+        for a in args:
+            shape = self.shapes.get(a)
+            if shape == ():
+                if not (a in self.constants and self.constants[a] == 1):
+                    # Multiplication by one, e.g. by dX when is_grad is set, is dropped.
+                    scale.append(a)
+            else:
+                matrices.append(a)
+        return scale, matrices
+
+    def _add_plan(self, plan, matrices):
+        stack = []
+        for step in plan:
+            if step == MULTIPLY:
+                right = stack.pop()
+                stack.append(self.add_instruction("dot", [stack.pop(), right]))
+            else:
+                stack.append(matrices[step])
+        return stack[0]
+
+    def add_dense(self, v):
+        """
+        Adds the instruction computing the inverse
+        if v is the value of a factorization.
+        """
+        if v in self.factorizations or isinstance(self.constants.get(v), Factorization):
+            return self.add_instruction("dense", [v])
+        return v
+
+    def _add_scale(self, scale, v):
+        for a in scale:
+            # np.dot with a scalar is a plain product.
+            v = self.add_instruction("mul", [a, v])
+        return v
+
+    def add_product(self, args):
+        """
+        Adds the instructions multiplying a chain of values, in the
+        order given by chain_plan if the shapes of the values are known.
+        """
+        scale, matrices = self._split_scalars(args)
+        if len(matrices) == 0:
+            matrices, scale = scale[:1], scale[1:]
+            if len(matrices) == 0:
+                return self.add_constant(1.)
+        if all(a in self.shapes for a in matrices):
+            plan = chain_plan(tuple(self.shapes[a] for a in matrices))
+        else:
+            plan = [0]
+            for i in range(1, len(matrices)):
+                plan.extend((i, MULTIPLY))
+        return self._add_scale(scale, self.add_dense(self._add_plan(plan, matrices)))
+
+    def add_trace(self, args):
+        """
+        Adds the instructions computing the trace of the product of a
+        chain of values, in the order given by trace_plan if the shapes
+        of the values are known.
+        """
+        scale, matrices = self._split_scalars(args)
+        plan = None
+        if len(matrices) > 0 and all(a in self.shapes for a in matrices):
+            plan = trace_plan(tuple(self.shapes[a] for a in matrices))
+        if plan is None:
+            v = self.add_instruction("trace", [self.add_product(matrices)]) \
+                if len(matrices) > 0 else self.add_constant(1.)
+        elif plan[1] is None:
+            v = self.add_instruction("trace", [self.add_dense(matrices[0])])
+        else:
+            v = self.add_instruction("trace_dot", [self._add_plan(plan[0], matrices),
+                                                   self._add_plan(plan[1], matrices)])
+        return self._add_scale(scale, v)
+
+    def plan_workspace(self):
+        """
+        Assigns buffers to the intermediate arrays that can be written
+        with out=, sharing a buffer between intermediates whose lifetimes
+        do not overlap. Outputs, and arrays that outputs are views of,
+        get no buffer, as they are returned to the caller.
+
+        Returns a tuple of
+          - buffers: Dict mapping values to (offset, shape, dtype)
+            in the workspace.
+          - report: Dict with the size of the workspace in workspace_bytes,
+            the largest total size of buffers in use at once in peak_bytes,
+            and the size of the arrays that would be allocated by each call
+            without a workspace in allocated_bytes.
+        """
+        num_instructions = len(self.instructions)
+        # end[v] is the index of the last instruction that uses v.
+        end = {}
+        for i, (out, op, args) in enumerate(self.instructions):
+            end[out] = i
+            for a in args:
+                end[a] = i
+        views = {}
+        for out, op, args in self.instructions:
+            if op == "transpose":
+                views[out] = views.get(args[0], args[0])
+        for v in self.outputs:
+            end[v] = num_instructions
+            end[views.get(v, v)] = num_instructions
+        # An array lives as long as its views.
+        for v, base in views.items():
+            end[base] = max(end[base], end[v])
+
+        free = {}
+        buffers = {}
+        buffer_of = {}
+        sizes = []
+        in_use = 0
+        peak = 0
+        allocated = 0
+        for i, (out, op, args) in enumerate(self.instructions):
+            if op in OUT_OPS and out in self.dtypes and end[out] < num_instructions:
+                key = (self.shapes[out], self.dtypes[out])
+                nbytes = int(np.prod(key[0])) * key[1].itemsize
+                allocated += nbytes
+                if len(free.get(key, ())) > 0:
+                    b = free[key].pop()
+                else:
+                    b = len(sizes)
+                    sizes.append((key, nbytes))
+                buffer_of[out] = b
+                in_use += nbytes
+                peak = max(peak, in_use)
+            # Release the buffers whose arrays are no longer used,
+            # after the output is assigned so that it never overlaps an input.
+            for v in set(args + (out,)):
+                if v in buffer_of and end[v] == i:
+                    b = buffer_of[v]
+                    key, nbytes = sizes[b]
+                    free.setdefault(key, []).append(b)
+                    in_use -= nbytes
+
+        offsets = []
+        workspace_bytes = 0
+        for key, nbytes in sizes:
+            offsets.append(workspace_bytes)
+            workspace_bytes += -(-nbytes // ALIGNMENT) * ALIGNMENT
+        for v, b in buffer_of.items():
+            key, _ = sizes[b]
+            buffers[v] = (offsets[b], key[0], key[1])
+        report = {
+            "workspace_bytes": workspace_bytes,
+            "peak_bytes": peak,
+            "allocated_bytes": allocated,
+        }
+        return buffers, report
+
+    def source(self, buffers=()):
+        """
+        Python source of a function computing the outputs from x.
+
+        Keyword args:
+          - buffers: Values to write into the buffer w<value> with out=.
+        """
+        def name(v):
+            return "x" if v == 0 else "v{}".format(v)
+
+        args = ["x"] + ["{0}={0}".format(name(v)) for v in sorted(self.constants)]
+        args.extend("w{0}=w{0}".format(v) for v in sorted(buffers))
+        lines = ["def compiled({}):".format(", ".join(args))]
+        for out, op, in_values in self.instructions:
+            if out in buffers:
+                lines.append("    {} = _out_{}({}, out=w{})".format(
+                    name(out), op, ", ".join(name(v) for v in in_values), out))
+                continue
+            lines.append("    {} = {}".format(
+                name(out), OPS[op][0].format(*[name(v) for v in in_values])))
+        if len(self.outputs) == 1:
+            lines.append("    return {}".format(name(self.outputs[0])))
+        else:
+            lines.append("    return ({},)".format(", ".join(name(v) for v in self.outputs)))
+        return "\n".join(lines)
+
+    def to_function(self, workspace=False):
+        """
+        Returns a new compiled function. The source is only compiled
+        on the first call for each value of workspace.
+
+        With workspace set, intermediates are written into a workspace
+        allocated here for this function alone, as planned by
+        plan_workspace, and the report of the plan is set as the memory
+        attribute of the function. The function must then not be called
+        from several threads at once.
+        """
+        if workspace not in self.code:
+            buffers, report = self.plan_workspace() if workspace else ({}, None)
+            code = compile(self.source(buffers), "<compiled>", "exec")
+            self.code[workspace] = (code, buffers, report)
+        code, buffers, report = self.code[workspace]
+        namespace = dict(_NAMESPACE)
+        namespace.update(("v{}".format(v), value) for v, value in self.constants.items())
+        if workspace:
+            arena = np.empty(report["workspace_bytes"], dtype=np.uint8)
+            for v, (offset, shape, dtype) in buffers.items():
+                nbytes = int(np.prod(shape)) * dtype.itemsize
+                namespace["w{}".format(v)] = arena[offset:offset + nbytes].view(dtype).reshape(shape)
+            report = dict(report)
+        exec(code, namespace)
+        compiled = namespace["compiled"]
+        compiled.memory = report
+        return compiled
+
+
+def lower(program, expr, wrt, const_dict, is_grad=False, values=None):
+    """
+    Adds the instructions evaluating expr to program, like Expr.eval.
+    Returns the number of the value holding the result.
+
+    Keyword args:
+      - values: Dict mapping already lowered (node, is_grad) pairs to their
+        values. Nodes that evaluate the same with and without is_grad,
+        i.e. that contain no trace, are stored under both keys, so they are
+        shared between the outputs of a program.
+    """
+    if values is None:
+        values = {}
+    todo = [expr]
+    while len(todo) > 0:
+        e = todo[-1]
+        if (e, is_grad) in values:
+            todo.pop()
+            continue
+        operands = e.operands()
+        pending = [c for c in operands if (c, is_grad) not in values]
+        if len(pending) > 0:
+            todo.extend(reversed(pending))
+            continue
+        todo.pop()
+
+        args = [values[c, is_grad] for c in operands]
+        if isinstance(e, (Variable, ScalarVariable)):
+            if e.name == wrt.name:
+                v = 0
+            else:
+                v = program.add_constant(const_dict[e.name])
+        elif isinstance(e, Scalar):
+            v = program.add_constant(e.value)
+        elif isinstance(e, NullExpr):
+            v = program.add_constant(0.)
+        elif isinstance(e, DifferentialExpr):
+            v = program.add_constant(1.)
+        elif isinstance(e, AddExpr):
+            v = program.add_instruction("add", args)
+        elif isinstance(e, SubExpr):
+            v = program.add_instruction("sub", args)
+        elif isinstance(e, SumExpr):
+            v = None
+            for c, a in zip(e.coefficients, args):
+                if c != 1:
+                    a = program.add_instruction("mul", [program.add_constant(c), a])
+                v = a if v is None else program.add_instruction("add", [v, a])
+        elif isinstance(e, (ScalarMulExpr, MatMulExpr, ProductExpr)):
+            v = program.add_product(args)
+        elif isinstance(e, TraceExpr):
+            v = program.add_product(args) if is_grad else program.add_trace(args)
+        elif isinstance(e, TransposeExpr):
+            v = program.add_instruction("transpose", args)
+        elif isinstance(e, InverseExpr):
+            v = program.add_dense(args[0])
+        elif isinstance(e, FactorizationExpr):
+            v = program.add_instruction("factorize", args)
+        else:
+            raise NotImplementedError(
+                "Cannot compile {}.".format(type(e).__name__))
+        values[e, is_grad] = v
+        if not e.contains(TraceExpr):
+            values[e, not is_grad] = v
+    return values[expr, is_grad]
+
+
+def lower_exprs(outputs, wrt, const_dict, x_shape=None, x_dtype=None):
+    """
+    Lowers several expressions to one Program, whose outputs are
+    their values. Subexpressions common to the expressions
+    are only computed once.
+
+    Args:
+      - outputs: Sequence of (expr, is_grad) pairs.
+
+    Keyword args:
+      - x_shape: Shape of x, used to order chains of products.
+      - x_dtype: dtype of x, if it is an ndarray.
+    """
+    program = Program(x_shape, x_dtype)
+    values = {}
+    for expr, is_grad in outputs:
+        program.outputs.append(lower(program, expr, wrt, const_dict, is_grad, values))
+    return program
+
+
+def compile_exprs(outputs, wrt, const_dict, x_shape=None, x_dtype=None, workspace=False):
+    """
+    Compiles several expressions to one function of x, returning the
+    tuple of their values, see lower_exprs.
+
+    Keyword args:
+      - workspace: Write intermediates into a workspace, see Program.to_function.
+    """
+    return lower_exprs(outputs, wrt, const_dict, x_shape, x_dtype).to_function(workspace)
+
+
+def compile_expr(expr, wrt, const_dict, is_grad=False, x_shape=None, x_dtype=None,
+                 workspace=False):
+    """
+    Compiles expr to a function of x, computing
+    expr.eval(x, wrt, const_dict, is_grad).
+    """
+    return compile_exprs([(expr, is_grad)], wrt, const_dict, x_shape, x_dtype, workspace)
+
+
+def lower_value_and_grad(expr, dexpr, wrt, const_dict, x_shape=None, x_dtype=None):
+    """
+    Lowers expr and its canonical differential dexpr to one Program,
+    whose outputs are the value of expr and its gradient with respect to x.
+    The gradient of Tr(A dX) is A', so it has the shape of x.
+    """
+    program = Program(x_shape, x_dtype)
+    values = {}
+    program.outputs.append(lower(program, expr, wrt, const_dict, False, values))
+    grad = lower(program, dexpr, wrt, const_dict, True, values)
+    program.outputs.append(program.add_instruction("transpose", [grad]))
+    return program
+
+
+def compile_value_and_grad(expr, dexpr, wrt, const_dict, x_shape=None, x_dtype=None,
+                           workspace=False):
+    """
+    Compiles expr and its canonical differential dexpr to one function
+    of x, returning the value of expr and its gradient with respect to x,
+    see lower_value_and_grad.
+    """
+    return lower_value_and_grad(expr, dexpr, wrt, const_dict, x_shape, x_dtype).to_function(
+        workspace)
+
+
+# Lowered programs, keyed on the expressions, the constants
+# and the shape and dtype of x. As the program depends on the shapes,
+# e.g. through the order of chains of products, this also caches
+# the plan for each shape signature. Workspaces are not cached, as
+# each function compiled from a program has its own.
+COMPILE_CACHE = LRUCache(maxsize=256)
+
+
+def same_constants(bound, const_dict):
+    """
+    Whether const_dict holds the same objects as bound, the
+    constants that a function was compiled with.
+    """
+    return len(bound) == len(const_dict) and \
+        all(k in bound and bound[k] is v for k, v in const_dict.items())
+
+
+def _cached(key, lower, const_dict, x):
+    consts = tuple(sorted((k, id(v)) for k, v in const_dict.items()))
+    key = key + (consts, np.shape(x), getattr(x, "dtype", type(x)))
+    entry = COMPILE_CACHE.get(key)
+    if entry is None or not same_constants(entry[0], const_dict):
+        x_dtype = x.dtype if isinstance(x, np.ndarray) else None
+        # The entry holds the constants, so that their ids in the key
+        # cannot be reused by other objects while it is cached.
+        entry = (dict(const_dict), lower(np.shape(x), x_dtype))
+        COMPILE_CACHE.put(key, entry)
+    return entry[1]
+
+
+def compiled_function(expr, wrt, const_dict, is_grad, x, workspace=False):
+    """
+    Returns a new compiled function of expr for inputs like x, from
+    the program in COMPILE_CACHE if possible. With workspace set, the
+    function has a workspace of its own, see Program.to_function.
+
+    The constants are bound when compiling, so they should not be
+    modified in place afterwards. Replacing an entry of const_dict
+    gives a different function.
+    """
+    return _cached(("expr", expr, wrt, is_grad),
+                   lambda x_shape, x_dtype: lower_exprs(
+                       [(expr, is_grad)], wrt, const_dict, x_shape, x_dtype),
+                   const_dict, x).to_function(workspace)
+
+
+def compiled_value_and_grad(expr, dexpr, wrt, const_dict, x, workspace=False):
+    """
+    Returns a new compiled value-and-gradient function of expr for
+    inputs like x, from the program in COMPILE_CACHE if possible.
+    """
+    return _cached(("value_and_grad", expr, dexpr, wrt),
+                   lambda x_shape, x_dtype: lower_value_and_grad(
+                       expr, dexpr, wrt, const_dict, x_shape, x_dtype),
+                   const_dict, x).to_function(workspace)
@@ -0,0 +1,176 @@
+"""
+Factorizations of inverted matrices.
+
+Products with an inverse, e.g. A^-1 B or B A^-1, are computed as
+linear solves with one factorization of A, which is cheaper and more
+accurate than forming A^-1. Exactly symmetric positive definite
+matrices use a Cholesky factorization and other matrices an LU
+factorization, from scipy.linalg. Sparse matrices use a sparse LU
+factorization from scipy.sparse.linalg. Without scipy, the inverse
+itself is computed once and used as the factorization. scipy is
+imported on the first factorization, as it takes long to import.
+
+@author Tommi Kerola
+
+"""
+
+import functools
+
+import numpy as np
+
+from matrix_calculus.sparse import issparse
+
+
+@functools.lru_cache(maxsize=None)
+def _linalg():
+    """
+    Returns scipy.linalg, or None without scipy.
+    """
+    try:
+        import scipy.linalg
+    except ImportError:
+        return None
+    return scipy.linalg
+
+
+class Factorization(object):
+    """
+    Factorization of a square matrix a, for computing
+    products with a^-1 without forming it.
+
+    A stack of matrices, i.e. a with more than two dimensions, is not
+    factorized; its products are computed with np.linalg.solve.
+    """
+
+    def __init__(self, a):
+        self._stack = None
+        self._inverse = None
+        self._cholesky = None
+        self._lu = None
+        self._splu = None
+        if issparse(a):
+            self.shape = a.shape
+            self.ndim = 2
+            import scipy.sparse.linalg
+            self._splu = scipy.sparse.linalg.splu(a.tocsc())
+            return
+        a = np.asarray(a)
+        self.shape = a.shape
+        self.ndim = a.ndim
+        if a.ndim > 2:
+            self._stack = a
+            return
+        sla = _linalg()
+        if sla is None:
+            self._inverse = np.linalg.inv(a)
+            return
+        # cho_factor only reads one triangle of a, so it is only used if a
+        # is exactly hermitian. Otherwise, even a small asymmetry would
+        # silently change the solves.
+        if np.array_equal(a, a.conj().T):
+            try:
+                self._cholesky = sla.cho_factor(a, check_finite=False)
+                return
+            except np.linalg.LinAlgError:
+                pass
+        self._lu = sla.lu_factor(a, check_finite=False)
+
+    def _solve(self, b, trans=0):
+        """
+        Returns a^-1 b, or a^-T b if trans is 1.
+        """
+        if issparse(b):
+            b = b.toarray()
+        if self._stack is not None:
+            a = self._stack if trans == 0 else np.swapaxes(self._stack, -1, -2)
+            return np.linalg.solve(a, b)
+        if np.ndim(b) > 2:
+            # Solve for a stack of right hand sides at once.
+            moved = np.moveaxis(b, -2, 0)
+            x = self._solve(np.reshape(moved, (moved.shape[0], -1)), trans)
+            return np.moveaxis(np.reshape(x, moved.shape), 0, -2)
+        if self._splu is not None:
+            return self._splu.solve(b, trans="N" if trans == 0 else "T")
+        elif self._cholesky is not None:
+            sla = _linalg()
+            if trans == 0:
+                return sla.cho_solve(self._cholesky, b, check_finite=False)
+            # a^T = conj(a), as a is hermitian.
+            return np.conj(sla.cho_solve(self._cholesky, np.conj(b), check_finite=False))
+        elif self._lu is not None:
+            return _linalg().lu_solve(self._lu, b, trans=trans, check_finite=False)
+        return np.dot(self._inverse if trans == 0 else self._inverse.T, b)
+
+    def solve(self, b):
+        """
+        Returns a^-1 b.
+        """
+        return self._solve(b)
+
+    def solve_left(self, b):
+        """
+        Returns b a^-1.
+        """
+        if np.ndim(b) < 2:
+            return self._solve(b, trans=1)
+        return np.swapaxes(self._solve(np.swapaxes(b, -1, -2), trans=1), -1, -2)
+
+    def inverse(self):
+        """
+        Returns a^-1, which is computed once.
+        It is dense even if a is sparse.
+        """
+        if self._inverse is None:
+            if self._stack is not None:
+                self._inverse = np.linalg.inv(self._stack)
+            else:
+                self._inverse = self.solve(np.eye(self.shape[0]))
+        return self._inverse
+
+
+def is_batch_scalar(a):
+    """
+    Whether a is a stack of scalars in batched evaluation,
+    i.e. has the shape (..., 1, 1).
+    """
+    return np.ndim(a) > 2 and np.shape(a)[-2:] == (1, 1)
+
+
+def factorize(a, batched=False):
+    """
+    Returns the Factorization of a, or 1/a for a scalar a.
+
+    Raises:
+     - NotImplementedError: If a is neither a scalar nor an ndarray.
+    """
+    if np.isscalar(a) or np.ndim(a) == 0 or batched and is_batch_scalar(a):
+        return np.reciprocal(a)
+    if isinstance(a, np.ndarray) or issparse(a):
+        return Factorization(a)
+    raise NotImplementedError
+
+
+def dense(a):
+    """
+    Returns the value of a, with a Factorization replaced by the inverse.
+    """
+    if isinstance(a, Factorization):
+        return a.inverse()
+    return a
+
+
+def dot(a, b, batched=False):
+    """
+    np.dot that computes products with a Factorization as solves,
+    and keeps products of sparse matrices sparse.
+    With batched set, stacks of matrices are multiplied like np.matmul.
+    """
+    if isinstance(a, Factorization):
+        return a.solve(dense(b))
+    elif isinstance(b, Factorization):
+        return b.solve_left(a)
+    elif issparse(a) or issparse(b):
+        return a @ b
+    elif batched:
+        return np.matmul(a, b)
+    return np.dot(a, b)
@@ -1,17 +1,224 @@
-
 import numpy as np
 
+from matrix_calculus.compiler import compile_expr, compiled_function, compiled_value_and_grad, \
+    same_constants
+from matrix_calculus.matrix_expr import DifferentialExpr
+from matrix_calculus.parallel import ParallelEvaluator
+
+
+def _key(x):
+    try:
+        return (x.shape, x.dtype)
+    except AttributeError:
+        return (np.shape(x), type(x))
+
 
-def expr2func(expr, wrt, const_dict, wrt_shape=None, res_shape=None, is_grad=False):
+def _compiled(compiled, x, const_dict, compile):
+    """
+    Returns the function compiled for inputs like x from compiled, a dict
+    keyed on the shape and dtype of x. The function is compiled with
+    compile(x) on the first call, and again when an entry of const_dict
+    has been replaced since.
+    """
+    key = _key(x)
+    entry = compiled.get(key)
+    if entry is None or not same_constants(entry[0], const_dict):
+        entry = (dict(const_dict), compile(x))
+        compiled[key] = entry
+    return entry[1]
+
+
+def _shape(shape):
+    return tuple(np.atleast_1d(shape))
+
+
+def _gradient(grad, x_shape):
+    """
+    Returns the gradient A' of a canonical differential Tr(A dX), given
+    A', for x of shape x_shape. If A has fewer axes than x, it holds
+    scalars a, e.g. from Tr(a dX) = aTr(dX), which stand for aI.
+
+    Raises:
+     - ValueError: If A is a scalar and x is not a square matrix.
+    """
+    if np.ndim(grad) < len(x_shape):
+        if len(x_shape) < 2 or x_shape[-1] != x_shape[-2]:
+            raise ValueError("The gradient aI of Tr(a dX) needs a square matrix X, "
+                             "but X has shape {}.".format(x_shape))
+        grad = np.asarray(grad)[..., None, None] * np.eye(x_shape[-1])
+        if grad.shape != x_shape:
+            grad = np.broadcast_to(grad, x_shape).copy()
+    return grad
+
+
+def _close():
+    pass
+
+
+def _evaluator(batched, workspace, workers):
+    """
+    Returns a tuple of the function evaluating a list of (expr, is_grad)
+    pairs without compiling, or None if the expressions are to be
+    compiled, and the function releasing its resources.
+    """
+    if not batched and workers is None:
+        return None, _close
+    if workspace:
+        raise ValueError("A workspace can only be used with compiled, unbatched "
+                         "and sequential evaluation.")
+    if workers is None:
+        return lambda outputs, x, wrt, const_dict: [
+            expr.eval(x, wrt, const_dict, is_grad, batched=batched)
+            for expr, is_grad in outputs], _close
+    evaluator = ParallelEvaluator(workers)
+    return lambda outputs, x, wrt, const_dict: evaluator.eval_exprs(
+        outputs, x, wrt, const_dict, batched), evaluator.close
+
+
+def expr2func(expr, wrt, const_dict, wrt_shape=None, res_shape=None, is_grad=False,
+              batched=False, workspace=False, workers=None):
     """
     Transforms an Expr to a functon
     of the wrt Variable.
+
+    The expression is compiled to a flat NumPy function on the first
+    call for each shape and dtype of x, with the constants in const_dict.
+    It is compiled again when an entry of const_dict is replaced, but
+    the constants must not be modified in place.
+
+    With batched set, x and the entries of const_dict can have leading
+    batch axes, and the function evaluates all of them in one pass,
+    see Expr.eval. wrt_shape and res_shape then apply to each
+    item of x, which has one batch axis.
+
+    With workspace set, the intermediate arrays are written into a
+    workspace that is allocated on the first call for each shape of x
+    and reused by later calls, see Program.to_function. f.memory then
+    reports the sizes of the workspace for the last shape of x.
+
+    With workers set, independent subexpressions are evaluated in
+    parallel on a pool of that many threads, see ParallelEvaluator,
+    instead of compiling the expression. f.close() shuts the pool down
+    once f is no longer used. For other functions it does nothing.
     """
+    evaluate, close = _evaluator(batched, workspace, workers)
+    if evaluate is not None:
+        def f(x):
+            if wrt_shape is not None:
+                x = np.reshape(x, (-1,) + _shape(wrt_shape) if batched else wrt_shape)
+            y, = evaluate([(expr, is_grad)], x, wrt, const_dict)
+            if res_shape is not None:
+                y = np.reshape(y, np.shape(y)[:1] + _shape(res_shape) if batched else res_shape)
+            return y
+        f.memory = None
+        f.close = close
+        return f
+
+    compiled = {}
+
     def f(x):
         if wrt_shape is not None:
             x = np.reshape(x, wrt_shape)
-        y = expr.eval(x, wrt, const_dict, is_grad)
+        func = _compiled(compiled, x, const_dict, lambda x: compiled_function(
+            expr, wrt, const_dict, is_grad, x, workspace))
+        f.memory = func.memory
+        y = func(x)
         if res_shape is not None:
             y = np.reshape(y, res_shape)
         return y
+    f.memory = None
+    f.close = close
+    return f
+
+
+def expr2value_and_grad(expr, dexpr, wrt, const_dict, wrt_shape=None, batched=False,
+                        workspace=False, workers=None):
+    """
+    Transforms an Expr and its canonical differential
+    to a function of the wrt Variable, returning
+    the value of expr and its gradient.
+
+    Both are computed in one pass that shares the intermediates common
+    to expr and dexpr. The gradient has the shape of the input, so the
+    function can be passed to e.g. scipy.optimize.minimize with jac=True.
+
+    With batched set, x and const_dict can have batch axes as in
+    expr2func, and the values and gradients of the whole batch
+    are returned. workspace, workers and f.close are as in expr2func.
+    """
+    evaluate, close = _evaluator(batched, workspace, workers)
+    if evaluate is not None:
+        def f(x):
+            shape = np.shape(x)
+            if wrt_shape is not None:
+                x = np.reshape(x, (-1,) + _shape(wrt_shape) if batched else wrt_shape)
+            y, grad = evaluate([(expr, False), (dexpr, True)], x, wrt, const_dict)
+            if np.ndim(grad) > 1:
+                grad = np.swapaxes(grad, -1, -2)
+            return y, np.reshape(_gradient(grad, np.shape(x)), shape)
+        f.memory = None
+        f.close = close
+        return f
+
+    compiled = {}
+
+    def f(x):
+        shape = np.shape(x)
+        if wrt_shape is not None:
+            x = np.reshape(x, wrt_shape)
+        func = _compiled(compiled, x, const_dict, lambda x: compiled_value_and_grad(
+            expr, dexpr, wrt, const_dict, x, workspace))
+        f.memory = func.memory
+        y, grad = func(x)
+        return y, np.reshape(_gradient(grad, np.shape(x)), shape)
+    f.memory = None
+    f.close = close
     return f
+
+
+def expr2hvp(ddexpr, wrt, const_dict, wrt_shape=None, workspace=False):
+    """
+    Transforms the canonical second differential of an expression,
+    i.e. canonical_differential(expr, wrt, hessian=True), to a function
+    hvp(x, v) returning the product of the Hessian at x with v.
+
+    The second differential is Tr(A dX), with A linear in the direction
+    d(X) that d() held constant, so with the direction set to v, A' is
+    the Hessian-vector product. The Hessian itself is never formed.
+
+    The second differential is compiled as a function of v, with x bound
+    as a constant, so the subexpressions that depend on x only, e.g.
+    factorizations, are computed once for each x. Solvers like Newton-CG
+    and trust-region methods take many products at the same x, for which
+    each product costs about as much as one gradient. The result has the
+    shape of v, so hvp can be passed as hessp to scipy.optimize.minimize.
+
+    workspace is as in expr2func.
+    """
+    # The constant that make_dx_constant replaced d(wrt) with.
+    direction = type(wrt)(str(DifferentialExpr(wrt, wrt)))
+    last = {}
+
+    def hvp(x, v):
+        shape = np.shape(v)
+        if wrt_shape is not None:
+            x = np.reshape(x, wrt_shape)
+            v = np.reshape(v, wrt_shape)
+        key = _key(v)
+        if last.get("key") != key or not np.array_equal(last["x"], x):
+            # Keep a copy, as x may be modified in place.
+            x = np.array(x)
+            consts = dict(const_dict)
+            consts[wrt.name] = x
+            last["func"] = compile_expr(ddexpr, direction, consts, True, np.shape(v),
+                                        v.dtype if isinstance(v, np.ndarray) else None,
+                                        workspace)
+            last["x"] = x
+            last["key"] = key
+        hvp.memory = last["func"].memory
+        y = last["func"](v)
+        if np.ndim(y) > 1:
+            y = np.swapaxes(y, -1, -2)
+        return np.reshape(_gradient(y, np.shape(v)), shape)
+    hvp.memory = None
+    return hvp
@@ -0,0 +1,32 @@
+"""
+Lazily imported modules.
+
+The symbolic part of the package, i.e. building, differentiating and
+canonicalizing expressions, needs no numerical libraries. Importing
+NumPy and SciPy takes much longer than importing the package itself, so
+they are only imported once an expression is evaluated.
+
+@author Tommi Kerola
+
+"""
+
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for the module name, which is imported when
+    one of its attributes is first accessed.
+
+    The attributes are then stored on the stand-in, so that
+    later accesses cost the same as on the module itself.
+    """
+
+    def __init__(self, name):
+        super(LazyModule, self).__init__(name)
+
+    def __getattr__(self, attr):
+        value = getattr(importlib.import_module(self.__name__), attr)
+        setattr(self, attr, value)
+        return value
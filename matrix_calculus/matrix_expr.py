@@ -5,78 +5,342 @@ Matrix expression classes.
 
 """
 
-import copy
+import weakref
+
+from matrix_calculus.lazy import LazyModule
+
+__all__ = [
+    "InternedType", "Expr", "DifferentialExpr", "Variable", "ScalarVariable", "Scalar",
+    "NullExpr", "AddExpr", "SubExpr", "SumExpr", "ScalarMulExpr", "MatMulExpr",
+    "ProductExpr", "TraceExpr", "StarExpr", "InverseExpr", "FactorizationExpr",
+    "TransposeExpr", "Tr", "make_sum", "make_product", "product_operands",
+    "print_structure",
+]
+
+# Only used in evaluation, so they are imported on first use.
+_np = LazyModule("numpy")
+_chain = LazyModule("matrix_calculus.chain")
+_factorization = LazyModule("matrix_calculus.factorization")
+_sparse = LazyModule("matrix_calculus.sparse")
+
+# Table of live expression nodes, see InternedType.
+_interned = weakref.WeakValueDictionary()
+
+
+def _pieces(expr, parts):
+    # The strings that make up the rendering of expr, in order. parts
+    # names the method giving the pieces of a node, see Expr._str_parts.
+    # Uses an explicit stack, so that deep expressions can be rendered.
+    todo = [expr]
+    while len(todo) > 0:
+        item = todo.pop()
+        if isinstance(item, Expr):
+            todo.extend(reversed(getattr(item, parts)()))
+        else:
+            yield item
+
+
+def _first_piece(expr, parts):
+    for piece in _pieces(expr, parts):
+        if piece:
+            return piece
+    return ""
+
+
+def _bracketed(expr, brackets):
+    return ["(", expr, ")"] if brackets else [expr]
+
+
+class InternedType(type):
+    """
+    Metaclass that hash-conses expression nodes.
+
+    Calling an expression class with the same arguments as an existing,
+    live node returns that node instead of creating a new one, so
+    structurally identical subtrees are represented by one shared object.
+    Child expressions are keyed by id(), which is safe since a node keeps
+    its children alive for as long as it is itself in the table.
+
+    As nodes are shared, they must never be mutated after construction.
+    Use Expr.with_children to build a modified copy of a node.
+    """
+
+    def __call__(cls, *args, **kwargs):
+        if kwargs:
+            return super(InternedType, cls).__call__(*args, **kwargs)
+        key = (cls,) + tuple(id(a) if isinstance(a, Expr) else (type(a), a)
+                             for a in args)
+        try:
+            node = _interned.get(key)
+        except TypeError:
+            # Unhashable argument, e.g. an array valued Scalar.
+            return super(InternedType, cls).__call__(*args)
+        if node is None:
+            node = super(InternedType, cls).__call__(*args)
+            # The children are already hashed, so this is cheap, and
+            # hashing never has to recurse down the tree later.
+            hash(node)
+            _interned[key] = node
+        return node
+
+
+class Expr(object, metaclass=InternedType):
+    """
+    Matrix expression base class.
+
+    Nodes are allocated in large numbers, e.g. by Hessian derivations,
+    so they have no __dict__. Each class declares the __slots__ for its
+    own fields, and the children are a tuple.
+    """
+    __slots__ = ("children", "_hash", "_contains", "__weakref__")
+
+    # The level of precedence of this kind of expression.
+    #
+    # Expressions with lower precedence level will be evaluated
+    # before expressions of higher level.
+    #
+    # Expressions of equal level will be evaluated from left to right.
+    #
+    # The below table follows the convention taken in C++:
+    # http://en.cppreference.com/w/c/language/operator_precedence
+    #
+    # Precedence level  Operator
+    # 0                 DifferentialExpr,TraceExpr
+    # 1                 Variable, Scalar, NullExpr, StarExpr, TransposeExpr, InverseExpr
+    # 2                 unary plus and minus
+    # 3                 MatMulExpr
+    # 4                 AddExpr, SubExpr
+    precedence_level = 1
+
+    def __init__(self, children=()):
+        super(Expr, self).__init__()
+        self.children = children
+        self._hash = None
+        # expr_type -> result of contains(expr_type).
+        self._contains = None
+
+    def __hash__(self):
+        # Nodes are immutable, so the hash is computed only once.
+        if self._hash is None:
+            self._hash = hash((type(self).__name__,) + tuple(self._args()))
+        return self._hash
+
+    def __copy__(self):
+        # Nodes are immutable and shared, so a copy is the node itself.
+        return self
 
-import numpy as np
+    def __deepcopy__(self, memo):
+        return self
 
+    def __reduce__(self):
+        # Pickle through the flat format of the serialize module, which
+        # stores shared subtrees once and does not recurse on deep trees.
+        from matrix_calculus import serialize
+        return (serialize.loads, (serialize.dumps(self),))
 
-class Expr(object):
-    def __init__(self, precedence_level):
+    def _args(self):
+        """
+        The constructor arguments of this node.
         """
-        Matrix expression base class.
+        return tuple(self.children)
 
-        Keyword args:
-          - precedence_level: The level of precedence of this expression.
+    def with_children(self, children):
+        """
+        Returns a node like this one, but with the given children.
+        """
+        if not self.children:
+            return self
+        return type(self)(*children)
 
-              Expressions with lower precedence level will be evaluated
-              before expressions of higher level.
+    @staticmethod
+    def from_string(s, scalars=None):
+        """
+        Parses an expression, e.g. "Tr((Y-D*X)'*(Y-D*X))",
+        see matrix_calculus.parser.
+        """
+        from matrix_calculus import parser
+        return parser.from_string(s, scalars)
 
-              Expressions of equal level will be evaluated from left to right.
+    def contains(self, expr_type):
+        """
+        Whether this expression has a node of type expr_type.
 
-              The below table follows the convention taken in C++:
-              http://en.cppreference.com/w/c/language/operator_precedence
+        As nodes are immutable, the result is stored on every node below
+        this one, so that later calls on them, e.g. from match_case for
+        each node that is rewritten, take constant time.
+        """
+        todo = [self]
+        while len(todo) > 0:
+            e = todo[-1]
+            if e._contains is not None and expr_type in e._contains:
+                todo.pop()
+                continue
+            found = isinstance(e, expr_type)
+            if not found:
+                pending = [c for c in e.children
+                           if c._contains is None or expr_type not in c._contains]
+                if len(pending) > 0:
+                    todo.extend(pending)
+                    continue
+                found = any(c._contains[expr_type] for c in e.children)
+            todo.pop()
+            if e._contains is None:
+                e._contains = {}
+            e._contains[expr_type] = found
+        return self._contains[expr_type]
 
-              Precedence level  Operator
-              0                 DifferentialExpr,TraceExpr
-              1                 Variable, Scalar, NullExpr, StarExpr, TransposeExpr, InverseExpr
-              2                 unary plus and minus
-              3                 MatMulExpr
-              4                 AddExpr, SubExpr
+    def make_dx_constant(self, wrt):
         """
-        super(Expr, self).__init__()
-        self.children = []
-        self.precedence_level = precedence_level
+        Returns this expression with each differential d(wrt) replaced
+        by a constant variable of the same name.
+        """
+        def is_dx(e):
+            return isinstance(e, DifferentialExpr) and e.children[0] == wrt
+
+        # node -> node with the differentials below it replaced.
+        mem = {}
+        todo = [self]
+        while len(todo) > 0:
+            e = todo[-1]
+            if e in mem:
+                todo.pop()
+                continue
+            pending = [c for c in e.children if c not in mem and not is_dx(c)]
+            if len(pending) > 0:
+                todo.extend(pending)
+                continue
+            todo.pop()
+            mem[e] = e.with_children([type(wrt)(str(c)) if is_dx(c) else mem[c]
+                                      for c in e.children])
+        return mem[self]
 
-    def __hash__(self):
-        raise NotImplementedError()
+    def toLatex(self):
+        return "".join(_pieces(self, "_latex_parts"))
 
-    def from_string(self, s):
-        pass
+    def _latex_parts(self):
+        return ("",)
 
-    def contains(self, expr_type):
-        if isinstance(self, expr_type):
-            return True
-        else:
-            return any(map(lambda c: c.contains(expr_type), self.children))
+    def eval(self, x, wrt, const_dict, is_grad=False, mem=None, batched=False):
+        """
+        Evaluates the expression with wrt set to x, and the other
+        variables taken from const_dict.
 
-    def make_dx_constant(self, wrt):
-        for i, child in enumerate(self.children):
-            if isinstance(child, DifferentialExpr) and child.children[0] == wrt:
-                const_child = copy.deepcopy(wrt)
-                const_child.name = str(child)
-                self.children[i] = const_child
-            else:
-                child.make_dx_constant(wrt)
+        Each distinct subexpression is evaluated only once, so subtrees
+        that occur several times, e.g. the residual in Tr((Y-DX)'(Y-DX)),
+        are computed once per call.
 
-    def toLatex(self):
-        return ""
+        Keyword args:
+          - is_grad: Evaluate a canonical differential Tr(AdX) as A.
+          - mem: Dict mapping subexpressions to their values. It can be
+              passed to several calls with the same x, const_dict and is_grad
+              in order to share the values between them.
+          - batched: Evaluate for a stack of inputs at once. x and the
+              entries of const_dict can then have leading batch axes, i.e.
+              a matrix of shape (..., m, n) or a scalar of shape (...,),
+              and the batch axes of all of them are broadcast together.
+              A scalar result has the shape of the batch axes.
+        """
+        if mem is None:
+            mem = {}
+        todo = [self]
+        while len(todo) > 0:
+            e = todo[-1]
+            if e in mem:
+                todo.pop()
+                continue
+            operands = e.operands()
+            pending = [c for c in operands if c not in mem]
+            if len(pending) > 0:
+                todo.extend(reversed(pending))
+                continue
+            todo.pop()
+            mem[e] = e.eval_node([mem[c] for c in operands], x, wrt, const_dict, is_grad, batched)
+        return self.finish_eval(mem[self], batched)
+
+    def finish_eval(self, value, batched):
+        """
+        Returns the result of eval, given the value of the expression.
+        """
+        if batched and _factorization.is_batch_scalar(value):
+            return value[..., 0, 0]
+        return value
+
+    def operands(self):
+        """
+        The subexpressions whose values eval_node takes as args.
+        """
+        return self.children
 
-    def eval(self, x, wrt, const_dict, is_grad=False):
+    def eval_node(self, args, x, wrt, const_dict, is_grad, batched):
+        """
+        Evaluates this node, given the values of its operands in args.
+        """
         raise NotImplementedError
 
     def __repr__(self):
         return self.__str__()
 
     def __str__(self):
-        return ""
+        return "".join(_pieces(self, "_str_parts"))
+
+    def _str_parts(self):
+        """
+        The pieces of str(self): strings, and the children that are
+        rendered in their place. Likewise _latex_parts for toLatex.
+        """
+        return ("",)
+
+    def short_str(self, max_depth=8, max_length=200):
+        """
+        str(self), with the subexpressions below max_depth shown as "...",
+        cut off after max_length characters. Unlike str, it takes the same
+        time for expressions of any size.
+        """
+        pieces = []
+        length = 0
+        todo = [(self, 0)]
+        while len(todo) > 0:
+            item, depth = todo.pop()
+            if isinstance(item, Expr):
+                if depth < max_depth:
+                    todo.extend((part, depth + 1) for part in reversed(item._str_parts()))
+                    continue
+                item = "..."
+            pieces.append(item)
+            length += len(item)
+            if length > max_length:
+                return "".join(pieces)[:max_length] + "..."
+        return "".join(pieces)
 
     def __len__(self):
-        return 1 + sum(map(len, self.children))
+        # The number of nodes in the tree, where
+        # shared subtrees are counted once per occurrence.
+        n = 0
+        todo = [self]
+        while len(todo) > 0:
+            n += 1
+            todo.extend(todo.pop().children)
+        return n
 
     def __eq__(self, other):
-        if type(self) != type(other):
-            return False
-        return self.children == other.children
+        todo = [(self, other)]
+        while len(todo) > 0:
+            a, b = todo.pop()
+            if a is b:
+                continue
+            if type(a) != type(b):
+                return False
+            if a._hash is not None and b._hash is not None and a._hash != b._hash:
+                return False
+            a_args, b_args = a._args(), b._args()
+            if len(a_args) != len(b_args):
+                return False
+            for a_arg, b_arg in zip(a_args, b_args):
+                if isinstance(a_arg, Expr):
+                    todo.append((a_arg, b_arg))
+                elif not (a_arg is b_arg or a_arg == b_arg):
+                    return False
+        return True
 
     def __ne__(self, other):
         return not (self == other)
@@ -92,10 +356,10 @@ class Expr(object):
             return AddExpr(self, other)
 
     def __sub__(self, other):
-        if type(self) == NullExpr:
-            return other
-        elif type(other) == NullExpr:
+        if type(other) == NullExpr:
             return self
+        elif type(self) == NullExpr:
+            return -other
         elif self == other:
             return NullExpr()
         else:
@@ -159,29 +423,28 @@ class Expr(object):
 
 
 class DifferentialExpr(Expr):
+    __slots__ = ("wrt",)
+    precedence_level = 0
+
     def __init__(self, expr, wrt):
-        super(DifferentialExpr, self).__init__(0)
-        self.children = [expr]
+        super(DifferentialExpr, self).__init__((expr,))
         self.wrt = wrt
 
-    def __hash__(self):
-        h = hash(self.wrt)
-        for c in self.children:
-            h *= hash(c)
-        return h
+    def _args(self):
+        return (self.children[0], self.wrt)
+
+    def with_children(self, children):
+        return DifferentialExpr(children[0], self.wrt)
 
-    def eval(self, x, wrt, const_dict, is_grad=False):
+    def eval_node(self, args, x, wrt, const_dict, is_grad, batched):
         return 1.
 
-    def __str__(self):
+    def _str_parts(self):
         brackets = self.precedence_level < self.children[0].precedence_level
-        return "d{}{}{}".format("(" if brackets else "", self.children[0], ")" if brackets else "")
+        return ["d"] + _bracketed(self.children[0], brackets)
 
-    def __eq__(self, other):
-        return self.children == other.children and self.wrt == other.wrt
-
-    def toLatex(self):
-        return r"\partial{{{}}}".format(self.children[0].toLatex())
+    def _latex_parts(self):
+        return (r"\partial{", self.children[0], "}")
 
 
 class Variable(Expr):
@@ -189,302 +452,423 @@ class Variable(Expr):
         "T",
     }
 
+    __slots__ = ("name",)
+    precedence_level = 1
+
     def __init__(self, name):
-        super(Variable, self).__init__(1)
+        super(Variable, self).__init__()
         if name in self.reserved_names:
             raise ValueError(
                 "Cannot create variable. \"{}\" is a reserved name.".format(name))
         self.name = name
 
-    def __hash__(self):
-        return hash(self.name)
+    def _args(self):
+        return (self.name,)
 
-    def eval(self, x, wrt, const_dict, is_grad=False):
+    def eval_node(self, args, x, wrt, const_dict, is_grad, batched):
         return x if wrt.name == self.name else const_dict[self.name]
 
-    def __str__(self):
-        return self.name
+    def _str_parts(self):
+        return (self.name,)
 
-    def __eq__(self, other):
-        if type(self) != type(other):
-            return False
-        return self.name == other.name
-
-    def toLatex(self):
-        return r"\mathbf{{{}}}".format(self.name)
+    def _latex_parts(self):
+        return (r"\mathbf{{{}}}".format(self.name),)
 
 
 class ScalarVariable(Expr):
     reserved_names = {
     }
 
+    __slots__ = ("name",)
+    precedence_level = 1
+
     def __init__(self, name):
-        super(ScalarVariable, self).__init__(1)
+        super(ScalarVariable, self).__init__()
         if name in self.reserved_names:
             raise ValueError(
                 "Cannot create variable. \"{}\" is a reserved name.".format(name))
         self.name = name
 
-    def __hash__(self):
-        return hash(self.name)
+    def _args(self):
+        return (self.name,)
 
-    def eval(self, x, wrt, const_dict, is_grad=False):
-        return x if wrt.name == self.name else const_dict[self.name]
-
-    def __str__(self):
-        return self.name
+    def eval_node(self, args, x, wrt, const_dict, is_grad, batched):
+        value = x if wrt.name == self.name else const_dict[self.name]
+        if batched and _np.ndim(value) > 0:
+            # A stack of scalars is broadcast like a stack of 1x1 matrices.
+            value = _np.reshape(value, _np.shape(value) + (1, 1))
+        return value
 
-    def __eq__(self, other):
-        if type(self) != type(other):
-            return False
-        return self.name == other.name
+    def _str_parts(self):
+        return (self.name,)
 
-    def toLatex(self):
-        return r"{{{}}}".format(self.name)
+    def _latex_parts(self):
+        return (r"{{{}}}".format(self.name),)
 
 
 class Scalar(Expr):
+    __slots__ = ("value",)
+    precedence_level = 1
+
     def __init__(self, value):
-        super(Scalar, self).__init__(1)
+        super(Scalar, self).__init__()
         self.value = value
 
-    def __hash__(self):
-        return hash(self.value)
+    def _args(self):
+        return (self.value,)
 
-    def eval(self, x, wrt, const_dict, is_grad=False):
+    def eval_node(self, args, x, wrt, const_dict, is_grad, batched):
         return self.value
 
-    def __str__(self):
-        return "{}".format(self.value)
+    def _str_parts(self):
+        return ("{}".format(self.value),)
 
-    def __eq__(self, other):
-        return self.value == other.value
-
-    def toLatex(self):
-        return r"{{{}}}".format(self.value)
+    def _latex_parts(self):
+        return (r"{{{}}}".format(self.value),)
 
 
 class NullExpr(Expr):
+    __slots__ = ()
+    precedence_level = 1
+
     def __init__(self):
-        super(NullExpr, self).__init__(1)
+        super(NullExpr, self).__init__()
 
-    def eval(self, x, wrt, const_dict, is_grad=False):
+    def eval_node(self, args, x, wrt, const_dict, is_grad, batched):
         return 0.
 
-    def __hash__(self):
-        return hash('null')
-
-    def __str__(self):
-        return "0"
-
-    def __eq__(self, other):
-        return type(self) == type(other)
+    def _str_parts(self):
+        return ("0",)
 
 
 class AddExpr(Expr):
-    def __init__(self, left, right):
-        super(AddExpr, self).__init__(4)
-        self.children = [left, right]
+    __slots__ = ()
+    precedence_level = 4
 
-    def __hash__(self):
-        h = hash('+')
-        for c in self.children:
-            h *= hash(c)
-        return h
+    def __init__(self, left, right):
+        super(AddExpr, self).__init__((left, right))
 
-    def eval(self, x, wrt, const_dict, is_grad=False):
-        return self.children[0].eval(x, wrt, const_dict, is_grad) + self.children[1].eval(x, wrt, const_dict, is_grad)
+    def eval_node(self, args, x, wrt, const_dict, is_grad, batched):
+        return _sparse.add(args[0], args[1])
 
-    def __str__(self):
-        return "{}+{}".format(self.children[0], self.children[1])
+    def _str_parts(self):
+        return (self.children[0], "+", self.children[1])
 
-    def toLatex(self):
-        return r"{{{}}}+{{{}}}".format(self.children[0].toLatex(), self.children[1].toLatex())
+    def _latex_parts(self):
+        return ("{", self.children[0], "}+{", self.children[1], "}")
 
 
 class SubExpr(Expr):
+    __slots__ = ()
+    precedence_level = 4
+
     def __init__(self, left, right):
-        super(SubExpr, self).__init__(4)
-        self.children = [left, right]
+        super(SubExpr, self).__init__((left, right))
 
-    def __hash__(self):
-        h = hash('-')
-        for c in self.children:
-            h *= hash(c)
-        return h
+    def eval_node(self, args, x, wrt, const_dict, is_grad, batched):
+        return _sparse.subtract(args[0], args[1])
 
-    def eval(self, x, wrt, const_dict, is_grad=False):
-        return self.children[0].eval(x, wrt, const_dict, is_grad) - self.children[1].eval(x, wrt, const_dict, is_grad)
+    def _str_parts(self):
+        return (self.children[0], "-", self.children[1])
 
-    def __str__(self):
-        return "{}-{}".format(self.children[0], self.children[1])
+    def _latex_parts(self):
+        return ("{", self.children[0], "}-{", self.children[1], "}")
 
-    def toLatex(self):
-        return r"{{{}}}-{{{}}}".format(self.children[0].toLatex(), self.children[1].toLatex())
+
+class SumExpr(Expr):
+    """
+    Sum of any number of terms, each with a constant coefficient,
+    e.g. A-2B+C. See make_sum and matrix_massage.flatten.
+    """
+
+    __slots__ = ("coefficients",)
+    precedence_level = 4
+
+    def __init__(self, coefficients, *terms):
+        super(SumExpr, self).__init__(terms)
+        self.coefficients = coefficients
+
+    def _args(self):
+        return (self.coefficients,) + self.children
+
+    def with_children(self, children):
+        return SumExpr(self.coefficients, *children)
+
+    def eval_node(self, args, x, wrt, const_dict, is_grad, batched):
+        result = None
+        for c, value in zip(self.coefficients, args):
+            if c != 1:
+                value = c * value
+            result = value if result is None else _sparse.add(result, value)
+        return result
+
+    def _terms(self, parts):
+        result = []
+        for i, (c, term) in enumerate(zip(self.coefficients, self.children)):
+            if type(term) == Scalar:
+                factor, term, brackets = "", Scalar(c * term.value), False
+            else:
+                factor = "" if c == 1 else "-" if c == -1 else "{}".format(c)
+                brackets = self.precedence_level <= term.precedence_level
+            first = factor or ("(" if brackets else _first_piece(term, parts))
+            if i > 0 and not first.startswith("-"):
+                result.append("+")
+            result.append(factor)
+            result.extend(_bracketed(term, brackets))
+        return result
+
+    def _str_parts(self):
+        return self._terms("_str_parts")
+
+    def _latex_parts(self):
+        return self._terms("_latex_parts")
+
+
+def product_operands(expr):
+    """
+    Returns the factors of a chain of products, e.g. [A, B, s, C]
+    for (AB)(sC), so that it can be evaluated in the best order.
+    """
+    operands = []
+    todo = [expr]
+    while len(todo) > 0:
+        e = todo.pop()
+        if isinstance(e, (ScalarMulExpr, MatMulExpr, ProductExpr)):
+            todo.extend(reversed(e.children))
+        elif isinstance(e, InverseExpr):
+            # Products with an inverse are computed as solves.
+            operands.append(FactorizationExpr(e.children[0]))
+        else:
+            operands.append(e)
+    return operands
 
 
 class ScalarMulExpr(Expr):
+    __slots__ = ()
+    precedence_level = 3
+
     def __init__(self, left, right):
-        super(ScalarMulExpr, self).__init__(3)
-        self.children = [left, right]
+        super(ScalarMulExpr, self).__init__((left, right))
 
-    def __hash__(self):
-        h = hash('*')
-        for c in self.children:
-            h *= hash(c)
-        return h
+    def operands(self):
+        return product_operands(self)
 
-    def eval(self, x, wrt, const_dict, is_grad=False):
-        return np.dot(self.children[0].eval(x, wrt, const_dict, is_grad), self.children[1].eval(x, wrt, const_dict, is_grad))
+    def eval_node(self, args, x, wrt, const_dict, is_grad, batched):
+        return _chain.multiply_chain(args, batched)
 
-    def __str__(self):
+    def _str_parts(self):
         left_brackets = self.precedence_level < self.children[0].precedence_level
         right_brackets = self.precedence_level < self.children[1].precedence_level
         if self.children[0] == Scalar(1):
-            return "{}{}{}".format(
-                "(" if right_brackets else "", self.children[1], ")" if right_brackets else "")
+            return _bracketed(self.children[1], right_brackets)
         else:
-            return "{}{}{}{}{}{}".format(
-                "(" if left_brackets else "", self.children[0], ")" if left_brackets else "",
-                "(" if right_brackets else "", self.children[1], ")" if right_brackets else "")
+            return (_bracketed(self.children[0], left_brackets) +
+                    _bracketed(self.children[1], right_brackets))
 
-    def toLatex(self):
-        left_brackets = self.precedence_level < self.children[0].precedence_level
-        right_brackets = self.precedence_level < self.children[1].precedence_level
-        if self.children[0] == Scalar(1):
-            return "{}{}{}".format(
-                "(" if right_brackets else "", self.children[1].toLatex(), ")" if right_brackets else "")
-        else:
-            return r"{}{}{}{}{}{}".format(
-                "(" if left_brackets else "", self.children[0].toLatex(
-                ), ")" if left_brackets else "",
-                "(" if right_brackets else "", self.children[1].toLatex(), ")" if right_brackets else "")
+    def _latex_parts(self):
+        return self._str_parts()
 
 
 class MatMulExpr(Expr):
+    __slots__ = ()
+    precedence_level = 3
+
     def __init__(self, left, right):
-        super(MatMulExpr, self).__init__(3)
-        self.children = [left, right]
+        super(MatMulExpr, self).__init__((left, right))
 
-    def __hash__(self):
-        h = hash('@')
-        for c in self.children:
-            h *= hash(c)
-        return h
+    def operands(self):
+        return product_operands(self)
 
-    def eval(self, x, wrt, const_dict, is_grad=False):
-        return np.dot(self.children[0].eval(x, wrt, const_dict, is_grad), self.children[1].eval(x, wrt, const_dict, is_grad))
+    def eval_node(self, args, x, wrt, const_dict, is_grad, batched):
+        return _chain.multiply_chain(args, batched)
 
-    def __str__(self):
+    def _str_parts(self):
         left_brackets = self.precedence_level < self.children[0].precedence_level
         right_brackets = self.precedence_level < self.children[1].precedence_level
-        return "{}{}{}{}{}{}".format(
-            "(" if left_brackets else "", self.children[0], ")" if left_brackets else "",
-            "(" if right_brackets else "", self.children[1], ")" if right_brackets else "")
+        return (_bracketed(self.children[0], left_brackets) +
+                _bracketed(self.children[1], right_brackets))
 
-    def toLatex(self):
-        left_brackets = self.precedence_level < self.children[0].precedence_level
-        right_brackets = self.precedence_level < self.children[1].precedence_level
-        return r"{}{}{}{}{}{}".format(
-            "(" if left_brackets else "", self.children[0].toLatex(
-            ), ")" if left_brackets else "",
-            "(" if right_brackets else "", self.children[1].toLatex(), ")" if right_brackets else "")
+    def _latex_parts(self):
+        return self._str_parts()
+
+
+class ProductExpr(Expr):
+    """
+    Product of any number of factors, e.g. sABC.
+    See make_product and matrix_massage.flatten.
+    """
+
+    __slots__ = ()
+    precedence_level = 3
+
+    def __init__(self, *factors):
+        super(ProductExpr, self).__init__(factors)
+
+    def with_children(self, children):
+        return ProductExpr(*children)
+
+    def operands(self):
+        return product_operands(self)
+
+    def eval_node(self, args, x, wrt, const_dict, is_grad, batched):
+        return _chain.multiply_chain(args, batched)
+
+    def _str_parts(self):
+        result = []
+        for c in self.children:
+            result.extend(_bracketed(c, self.precedence_level < c.precedence_level))
+        return result
+
+    def _latex_parts(self):
+        return self._str_parts()
 
 
 class TraceExpr(Expr):
+    __slots__ = ()
+    precedence_level = 0
+
     def __init__(self, expr):
-        super(TraceExpr, self).__init__(0)
-        self.children = [expr]
+        super(TraceExpr, self).__init__((expr,))
 
-    def __hash__(self):
-        h = hash('Tr')
-        for c in self.children:
-            h *= hash(c)
-        return h
+    def operands(self):
+        # The trace of a product is computed from its factors,
+        # see trace_chain.
+        return product_operands(self.children[0])
 
-    def eval(self, x, wrt, const_dict, is_grad=False):
+    def eval_node(self, args, x, wrt, const_dict, is_grad, batched):
         if is_grad:
-            return self.children[0].eval(x, wrt, const_dict, is_grad)
+            return _chain.multiply_chain(args, batched)
         else:
-            return np.trace(self.children[0].eval(x, wrt, const_dict, is_grad))
+            return _chain.trace_chain(args, batched)
 
-    def __str__(self):
-        return "Tr({})".format(self.children[0])
+    def _str_parts(self):
+        return ("Tr(", self.children[0], ")")
 
-    def toLatex(self):
-        return r"\mathrm{{Tr}}({})".format(self.children[0].toLatex())
+    def _latex_parts(self):
+        return (r"\mathrm{Tr}(", self.children[0], ")")
 
 
 class StarExpr(Expr):  # Any operator that rearranges elements
+    __slots__ = ("symbol",)
+    precedence_level = 1
+
     def __init__(self, expr, symbol):
-        super(StarExpr, self).__init__(1)
-        self.children = [expr]
+        super(StarExpr, self).__init__((expr,))
         self.symbol = symbol
 
-    def __hash__(self):
-        h = hash('star')
-        for c in self.children:
-            h *= hash(c)
-        return h
+    def _args(self):
+        return (self.children[0], self.symbol)
 
-    def eval(self, x, wrt, const_dict, is_grad):
+    def with_children(self, children):
+        return StarExpr(children[0], self.symbol)
+
+    def eval_node(self, args, x, wrt, const_dict, is_grad, batched):
         raise NotImplementedError
 
-    def __str__(self):
+    def _str_parts(self):
         brackets = self.precedence_level < self.children[0].precedence_level
-        return "{}{}{}{}".format("(" if brackets else "", self.children[0], ")" if brackets else "", self.symbol)
+        return _bracketed(self.children[0], brackets) + [self.symbol]
 
-    def toLatex(self):
+    def _latex_parts(self):
         brackets = self.precedence_level < self.children[0].precedence_level
-        return r"{{{}{}{}}}{}".format("(" if brackets else "", self.children[0].toLatex(), ")" if brackets else "", self.symbol)
+        return ["{"] + _bracketed(self.children[0], brackets) + ["}", self.symbol]
 
 
 class InverseExpr(Expr):
+    __slots__ = ()
+    precedence_level = 1
+
     def __init__(self, expr):
-        super(InverseExpr, self).__init__(1)
-        self.children = [expr]
+        super(InverseExpr, self).__init__((expr,))
 
-    def __hash__(self):
-        h = hash('inverse')
-        for c in self.children:
-            h *= hash(c)
-        return h
-
-    def eval(self, x, wrt, const_dict, is_grad):
-        cval = self.children[0].eval(x, wrt, const_dict, is_grad)
-        if np.isscalar(cval):
-            return np.reciprocal(cval)
-        if isinstance(cval, np.ndarray):
-            return np.linalg.inv(cval)
-        raise NotImplementedError
+    def operands(self):
+        # The factorization is shared with the products
+        # that contain this inverse, see product_operands.
+        return (FactorizationExpr(self.children[0]),)
 
-    def __str__(self):
+    def eval_node(self, args, x, wrt, const_dict, is_grad, batched):
+        return _factorization.dense(args[0])
+
+    def _str_parts(self):
         brackets = self.precedence_level < self.children[0].precedence_level
-        return "{}{}{}{}".format("(" if brackets else "", self.children[0], ")" if brackets else "", '^(-1)')
+        return _bracketed(self.children[0], brackets) + ['^(-1)']
 
-    def toLatex(self):
+    def _latex_parts(self):
         brackets = self.precedence_level < self.children[0].precedence_level
-        return r"{{{}{}{}}}^{{{}}}".format("(" if brackets else "", self.children[0].toLatex(), ")" if brackets else "", -1)
+        return ["{"] + _bracketed(self.children[0], brackets) + ["}^{-1}"]
+
+
+class FactorizationExpr(Expr):
+    """
+    The factorization of the inverted expr, see factorize.
+
+    Only used as an operand of InverseExpr and of products, so that each
+    inverted subexpression is factorized once per evaluation.
+    """
+
+    __slots__ = ()
+    precedence_level = 1
+
+    def __init__(self, expr):
+        super(FactorizationExpr, self).__init__((expr,))
+
+    def eval_node(self, args, x, wrt, const_dict, is_grad, batched):
+        return _factorization.factorize(args[0], batched)
+
+    def _str_parts(self):
+        return ("Factorization(", self.children[0], ")")
 
 
 class TransposeExpr(StarExpr):
+    __slots__ = ()
+
     def __init__(self, expr):
         super(TransposeExpr, self).__init__(expr, "'")
 
-    def __hash__(self):
-        h = hash('T')
-        for c in self.children:
-            h *= hash(c)
-        return h
+    def _args(self):
+        return (self.children[0],)
+
+    def with_children(self, children):
+        return TransposeExpr(children[0])
 
-    def eval(self, x, wrt, const_dict, is_grad):
-        return np.transpose(self.children[0].eval(x, wrt, const_dict, is_grad))
+    def eval_node(self, args, x, wrt, const_dict, is_grad, batched):
+        if batched and _np.ndim(args[0]) > 2:
+            return _np.swapaxes(args[0], -1, -2)
+        return _sparse.transpose(args[0])
 
 
 def Tr(expr):
     return TraceExpr(expr)
 
 
+def make_sum(coefficients, terms):
+    """
+    Returns the sum of the terms times the coefficients, without the
+    zero terms, as a SumExpr, or as a single term or NullExpr if possible.
+    """
+    pairs = [(c, t) for c, t in zip(coefficients, terms)
+             if type(t) != NullExpr and not (isinstance(c, (int, float, complex)) and c == 0)]
+    if len(pairs) == 0:
+        return NullExpr()
+    elif len(pairs) == 1 and pairs[0][0] == 1:
+        return pairs[0][1]
+    return SumExpr(tuple(c for c, _ in pairs), *(t for _, t in pairs))
+
+
+def make_product(factors):
+    """
+    Returns the product of the factors as a ProductExpr,
+    or as a single factor or NullExpr if possible.
+    """
+    if any(type(f) == NullExpr for f in factors):
+        return NullExpr()
+    elif len(factors) == 0:
+        return Scalar(1)
+    elif len(factors) == 1:
+        return factors[0]
+    return ProductExpr(*factors)
+
+
 def print_structure(expr):
     pipe_dict = {0: " "}
     qs = [(0, pipe_dict, expr)]
@@ -3,7 +3,6 @@ Utilty functions for matching matrix expressions with gradient rules.
 """
 import itertools
 
-from collections import defaultdict
 from matrix_calculus.matrix_expr import *
 
 
@@ -11,68 +10,159 @@ def peel(expr):
     return expr.children
 
 
+class CaseIndex(object):
+    """
+    Index over a set of cases, used by match_deepest.
+
+    Each case is compiled once into a signature of the node types it can
+    match, at its top node and at the children of its top node. Expression
+    nodes are then looked up on their own type and the types of their
+    children, so that only the cases that can possibly match are tried.
+    The lookup results are filled in lazily, once per combination of types.
+    """
+
+    def __init__(self, cases):
+        self.cases = list(cases)
+        self.case_vars = [get_var_names(case) for case in self.cases]
+        self.case_lens = [len(case) for case in self.cases]
+        self.signatures = [case_signature(case) for case in self.cases]
+        self.buckets = {}
+        # Counters for the number of nodes looked up and cases tried.
+        self.num_lookups = 0
+        self.num_attempts = 0
+
+    def __len__(self):
+        return len(self.cases)
+
+    def candidates(self, expr):
+        """
+        Returns the indices of the cases that may match expr.
+        """
+        key = (type(expr),) + tuple(type(c) for c in expr.children)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = [i for i, signature in enumerate(self.signatures)
+                      if signature_accepts(signature, key)]
+            self.buckets[key] = bucket
+        return bucket
+
+
+def strip_differential(case):
+    while type(case) == DifferentialExpr:
+        case = case.children[0]
+    return case
+
+
+def accepted_types(case):
+    """
+    The expression types that case can match,
+    or None if it can match anything.
+    """
+    case = strip_differential(case)
+    if type(case) == Variable:
+        return None
+    elif type(case) == ScalarVariable:
+        return (Scalar, ScalarVariable)
+    return (type(case),)
+
+
+def case_signature(case):
+    """
+    Returns (head_types, child_types) for case, where
+    head_types are the types the top node can match and child_types
+    holds the types each of its children can match (None for any type).
+    Returns None if the case can match any node.
+    """
+    head_types = accepted_types(case)
+    if head_types is None:
+        return None
+    child_types = [accepted_types(child)
+                   for child in strip_differential(case).children]
+    return head_types, child_types
+
+
+def signature_accepts(signature, key):
+    if signature is None:
+        return True
+    head_types, child_types = signature
+    if key[0] not in head_types:
+        return False
+    for types, child_type in zip(child_types, key[1:]):
+        if types is not None and child_type not in types:
+            return False
+    return True
+
+
 def match_deepest(expr, cases):
+    """
+    Returns the cases matching expr, with the deepest case first.
+
+    cases can be any iterable of cases, or a CaseIndex over them.
+    """
+    if not isinstance(cases, CaseIndex):
+        cases = CaseIndex(cases)
+    cases.num_lookups += 1
     matches = []
-    for case in cases:
+    for i in cases.candidates(expr):
+        cases.num_attempts += 1
         case_expr_matches = {}
         try:
-            match_case(expr, case, case_expr_matches)
+            match_case(expr, cases.cases[i], case_expr_matches)
         except MatchError:
             continue
-        case_vars = get_var_names(case)
-        if set(case_expr_matches.keys()) == case_vars:
-            matches.append(case)
-    matches.sort(key=lambda x: -len(x))  # Put deepest case first
-    return matches
+        if set(case_expr_matches.keys()) == cases.case_vars[i]:
+            matches.append(i)
+    matches.sort(key=lambda i: -cases.case_lens[i])  # Put deepest case first
+    return [cases.cases[i] for i in matches]
 
 
 def match_case(expr, case, d):
-    if type(case) == Variable:
-        # expr can contain anything
-        if case.name in d:
-            if d[case.name] != expr:
-                raise MatchError("Variable {} cannot correspond to both {} and {}.".format(
-                    case.name, d[case.name], expr))
-        else:
-            d[case.name] = expr
-    elif type(case) == ScalarVariable:
-        # expr can contain a scalar
-        if type(expr) == Scalar or type(expr) == ScalarVariable:
-            if case.name in d:
-                if d[case.name] != expr:
-                    raise MatchError("Variable {} cannot correspond to both {} and {}.".format(
-                        case.name, d[case.name], expr))
+    """
+    Matches expr to case, setting d[name] to the subexpression that each
+    variable of case corresponds to.
+
+    Raises:
+     - MatchError: If expr and case do not match.
+    """
+    todo = [(expr, case)]
+    while len(todo) > 0:
+        expr, case = todo.pop()
+        if type(case) == Variable:
+            # expr can contain anything
+            match_var(case, expr, d)
+        elif type(case) == ScalarVariable:
+            # expr can contain a scalar
+            if type(expr) == Scalar or type(expr) == ScalarVariable:
+                match_var(case, expr, d)
             else:
-                d[case.name] = expr
-        else:
-            raise MatchError("No match at scalar case.")
-    elif type(case) == DifferentialExpr:
-        if expr.contains(DifferentialExpr):
-            # Throw away the DifferentialExpr in the case
-            # Re-evaluate expr at the next level
-            match_case(expr, case.children[0], d)
+                raise MatchError("No match at scalar case.")
+        elif type(case) == DifferentialExpr:
+            if expr.contains(DifferentialExpr):
+                # Throw away the DifferentialExpr in the case
+                # Re-evaluate expr at the next level
+                todo.append((expr, case.children[0]))
+            else:
+                raise MatchError("No match at differential operator.")
+        elif type(case) == type(expr):
+            # The structure of the case and expr matches, look at subcases.
+            if type(case) == Scalar and case.value != expr.value:
+                raise MatchError("No match at scalar {}.".format(case))
+            if isinstance(case, StarExpr) and case.symbol != expr.symbol:
+                raise MatchError("No match at operator {}.".format(case.symbol))
+            # This case is matching if all subcases are matching,
+            # with the same subexpression for each variable.
+            todo.extend(reversed(list(zip(peel(expr), peel(case)))))
         else:
-            raise MatchError("No match at differential operator.")
-    elif type(case) == type(expr):
-        # The structure of the case and expr matches, look at subcases.
-        subcases = peel(case)
-        subexprs = peel(expr)
-        # This case is matching if all subcases are matching
-        dsubs = []
-        for subexpr, subcase in zip(subexprs, subcases):
-            dsub = {}
-            match_case(subexpr, subcase, dsub)
-            case_vars = get_var_names(subcase)
-            # Make sure all case keys were set
-            for varname in case_vars:
-                if varname in d:
-                    if not varname in dsub:
-                        raise MatchError(
-                            "Match in one child, but not the other.")
-                    elif d[varname] != dsub[varname]:
-                        raise MatchError(
-                            "Vars in subexpressions matches to different expressions.")
-            d.update(dsub)
+            raise MatchError("No match at {}.".format(type(case).__name__))
+
+
+def match_var(case, expr, d):
+    if case.name in d:
+        if d[case.name] != expr:
+            raise MatchError("Variable {} cannot correspond to both {} and {}.".format(
+                case.name, d[case.name], expr))
+    else:
+        d[case.name] = expr
 
 
 def translate_case(expr, start_case, end_case):
@@ -86,45 +176,49 @@ def translate_case(expr, start_case, end_case):
     Raises:
      - MatchError: If expr and start_case does not match.
     """
-    end_case = copy.deepcopy(end_case)
     # Get a list of all the variables in start_case and end_case.
     # These must be same
-    start_var_parent_dict = defaultdict(list)
-    end_var_parent_dict = defaultdict(list)
-    create_vars_parent_dict(start_case, start_var_parent_dict)
-    create_vars_parent_dict(end_case, end_var_parent_dict)
-    # print ""
-    # print start_var_parent_dict
-    # print end_var_parent_dict
-
-    if start_var_parent_dict.keys() != end_var_parent_dict.keys():
+    start_var_names = set()
+    end_var_names = set()
+    get_child_var_names(start_case, start_var_names)
+    get_child_var_names(end_case, end_var_names)
+
+    if start_var_names != end_var_names:
         raise ValueError(
             "Start case and end case must contain the same variables.")
 
     case_expr_matches = {}
     match_case(expr, start_case, case_expr_matches)
-    # print start_case,"->",end_case
-    # print case_expr_matches
 
-    for varname in end_var_parent_dict.keys():
-        for (child_index, parent) in end_var_parent_dict[varname]:
-            subexpr = case_expr_matches[varname]
-            if isinstance(parent, TransposeExpr) and isinstance(subexpr, TransposeExpr):
+    return substitute_case(end_case, case_expr_matches)
+
+
+def substitute_case(case, case_expr_matches):
+    """
+    Builds a new expression from case, where each Variable
+    and ScalarVariable is replaced by the subexpression it was matched to.
+    """
+    children = []
+    for child in case.children:
+        if isinstance(child, (Variable, ScalarVariable)):
+            subexpr = case_expr_matches[child.name]
+            if isinstance(case, TransposeExpr) and isinstance(subexpr, TransposeExpr):
                 # A bit of a hack for avoiding X'', and returning X instead.
-                i, p = get_parent(parent, end_case)
-                p.children[i] = subexpr.children[0]
-            else:
-                parent.children[child_index] = subexpr
-    return end_case
+                return subexpr.children[0]
+            children.append(subexpr)
+        else:
+            children.append(substitute_case(child, case_expr_matches))
+    return case.with_children(children)
 
 
-def create_vars_parent_dict(expr, d):
-    for child_index, child in enumerate(expr.children):
-        if isinstance(child, Variable):
-            # Map variable to its parent
-            d[child.name].append((child_index, expr))
+def get_child_var_names(expr, nameset):
+    todo = list(expr.children)
+    while len(todo) > 0:
+        e = todo.pop()
+        if isinstance(e, (Variable, ScalarVariable)):
+            nameset.add(e.name)
         else:
-            create_vars_parent_dict(child, d)
+            todo.extend(e.children)
 
 
 def get_var_names(expr):
@@ -134,21 +228,16 @@ def get_var_names(expr):
 
 
 def get_var_names_(expr, nameset):
-    if isinstance(expr, Variable) or isinstance(expr, ScalarVariable):
-        nameset.add(expr.name)
-    for child in expr.children:
-        get_var_names_(child, nameset)
-
-
-def get_parent(expr, parent):
-    for child_index, child in enumerate(parent.children):
-        if id(expr) == id(child):
-            return child_index, parent
-        else:
-            child_child_index, child_parent = get_parent(expr, child)
-            if not child_parent is None:
-                return child_child_index, child_parent
-    return -1, None
+    seen = set()
+    todo = [expr]
+    while len(todo) > 0:
+        e = todo.pop()
+        if isinstance(e, Variable) or isinstance(e, ScalarVariable):
+            nameset.add(e.name)
+        for c in e.children:
+            if c not in seen:
+                seen.add(c)
+                todo.append(c)
 
 
 class MatchError(Exception):
@@ -4,29 +4,55 @@
 
 """
 
-import copy
+import collections
 import functools
+import warnings
+from matrix_calculus.base import d, d_all
+from matrix_calculus.cache import CanonicalCache, fingerprint
+from matrix_calculus.lazy import LazyModule
 from matrix_calculus.matrix_expr import *
-from matrix_calculus.matrix_expr_match import match_deepest, translate_case
+from matrix_calculus.matrix_expr_match import CaseIndex, match_deepest, translate_case
+
+# Only used with a DiskCache, so it is imported on first use, see lazy.
+hashlib = LazyModule("hashlib")
 
 CANONICAL_VERBOSE = True
 
+# Version of the entries stored in a DiskCache by canonical_differential.
+# Bump this when a change affects the results without changing the rules.
+DERIVATION_CACHE_VERSION = 2
 
-def massage2canonical(expr, verbose=True):
-    """
-    Massages the given expression
-    to canonical form with the dX
-    at the top level, if possible.
 
-    An expression is in canonical form if it is written as Tr(AdX),
-    so that dX is on the right side.
+class RuleSet(object):
+    """
+    A set of rewrite rules (cases), compiled for matching.
 
-    For each non-canonical expression, expand only the branch that contains a dX.
-    For each canonical expression, combine it with other canonical expressions.
+    Keyword args:
+      - cases: Dict mapping each start case to its end case.
     """
-    global CANONICAL_VERBOSE
-    CANONICAL_VERBOSE = verbose
 
+    def __init__(self, cases):
+        self.cases = cases
+        self.index = CaseIndex(cases.keys())
+        self._fingerprint = None
+
+    def fingerprint(self):
+        """
+        A digest of the rules, stable across processes.
+        """
+        if self._fingerprint is None:
+            h = hashlib.sha256()
+            for start_case, end_case in self.cases.items():
+                h.update(fingerprint(start_case).encode())
+                h.update(fingerprint(end_case).encode())
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
+
+
+def make_rule_sets():
+    """
+    Returns the two rule sets used by massage2canonical.
+    """
     def d(e): return DifferentialExpr(e, X)
 
     X = Variable("X")
@@ -38,7 +64,7 @@ def massage2canonical(expr, verbose=True):
     # In all cases, d(X) represents an expression that contains
     # a differential, and is only used for matching.
     # The right-hand side of each case does not contain this differential.
-    cases = {
+    stage1_cases = {
         Tr(d(A)*B): Tr(B*A),
         d(Tr(A+B)): Tr(A) + Tr(B),
         d(Tr(A-B)): Tr(A) - Tr(B),
@@ -65,10 +91,7 @@ def massage2canonical(expr, verbose=True):
         # d(A-B): A-B,
     }
 
-    print('try 1')
-    expr = massage2canonical_stage1(expr, cases, [1], {}, prev_case=True)
-
-    cases = {
+    stage2_cases = {
         Tr(d(A)*B): Tr(B*A),
         d(Tr(A+B)): Tr(A) + Tr(B),
         d(Tr(A-B)): Tr(A) - Tr(B),
@@ -86,7 +109,6 @@ def massage2canonical(expr, verbose=True):
         A*d(B-C): A*B - A*C,
         # For changing associativity so that B (or C) can eventually move to the right side (use the Tr rule above)
         Tr(A*d(B*C)): Tr((A*B)*C),
-        A*(B*C): (A*B)*C,
         s*u*Tr(A): s*Tr(u*A),
         X*s.I: s.I*X,
         (s*X).I: s.I*X.I,
@@ -109,89 +131,527 @@ def massage2canonical(expr, verbose=True):
         d(A+B): A+B,
         d(A-B): A-B,
     }
-    print('try 2')
-    expr = massage2canonical_stage1(expr, cases, [1], {}, prev_case=True)
-    print('try 3')
-    expr = massage2canonical_stage1(expr, cases, [1], {}, prev_case=True)
+    return RuleSet(stage1_cases), RuleSet(stage2_cases)
+
+
+STAGE1_RULES, STAGE2_RULES = make_rule_sets()
+
+
+def massage2canonical(expr, verbose=True, cache=None):
+    """
+    Massages the given expression
+    to canonical form with the dX
+    at the top level, if possible.
+
+    An expression is in canonical form if it is written as Tr(AdX),
+    so that dX is on the right side.
+
+    For each non-canonical expression, expand only the branch that contains a dX.
+    For each canonical expression, combine it with other canonical expressions.
+
+    The expanded expression is flattened, see flatten, before the second
+    stage, so that its like terms are combined and it does not depend on
+    the associativity of its products, and unflattened for the rules to
+    match. The result is put in the same form.
+
+    Keyword args:
+      - verbose: Print each rewrite that is applied.
+      - cache: CanonicalCache shared between calls. The canonical forms of
+          subexpressions are then only computed once per process.
+    """
+    global CANONICAL_VERBOSE
+    CANONICAL_VERBOSE = verbose
+
+    expr = massage2canonical_stage1(expr, STAGE1_RULES, cache=cache)
+    expr = unflatten(flatten(expr))
+    expr = massage2canonical_stage1(expr, STAGE2_RULES, cache=cache)
+    expr = unflatten(flatten(expr))
 
     # print("after stage1:",expr)
     # expr = massage2canonical_stage2(expr)
     return expr
 
 
+def massage2canonical_all(exprs, verbose=True, cache=None):
+    """
+    Massages several expressions to canonical form, like massage2canonical,
+    in one pass that shares the normal forms of their common subexpressions.
+    Returns the list of canonical forms.
+    """
+    global CANONICAL_VERBOSE
+    CANONICAL_VERBOSE = verbose
+
+    mem = {}
+    exprs = [massage2canonical_stage1(expr, STAGE1_RULES, mem=mem, cache=cache) for expr in exprs]
+    exprs = [unflatten(flatten(expr)) for expr in exprs]
+    mem = {}
+    exprs = [massage2canonical_stage1(expr, STAGE2_RULES, mem=mem, cache=cache) for expr in exprs]
+    return [unflatten(flatten(expr)) for expr in exprs]
+
+
+def canonical_differential_all(expr, wrts=None, cache=None):
+    """
+    Computes the canonical differentials of expr with respect to
+    several variables, with one pass of d_all and one shared
+    canonicalization pass.
+
+    Keyword args:
+      - wrts: Variables, see d_all.
+      - cache: CanonicalCache, passed on to massage2canonical_all.
+
+    Returns a dict mapping each variable to its canonical differential.
+    """
+    dexprs = d_all(expr, wrts)
+    canonical = massage2canonical_all(list(dexprs.values()), verbose=False, cache=cache)
+    return dict(zip(dexprs, canonical))
+
+
+def derivation_key(expr, wrt, hessian=False):
+    """
+    Key of the canonical differential of expr in a DiskCache. It covers
+    the expression, wrt, the hessian flag and the version of the rules.
+    """
+    h = hashlib.sha256()
+    for part in [str(DERIVATION_CACHE_VERSION), STAGE1_RULES.fingerprint(),
+                 STAGE2_RULES.fingerprint(), fingerprint(expr),
+                 fingerprint(wrt), str(bool(hessian))]:
+        h.update(part.encode() + b"|")
+    return h.hexdigest()
+
+
+def canonical_differential(expr, wrt, hessian=False, disk_cache=None, cache=None):
+    """
+    Computes d(expr) with respect to wrt and massages it to canonical form.
+
+    Keyword args:
+      - hessian: Take the second differential, see d().
+      - disk_cache: DiskCache to look up the result in, and to store it to.
+      - cache: CanonicalCache, passed on to massage2canonical.
+    """
+    if type(expr) == str:
+        expr = Expr.from_string(expr)
+    if type(wrt) == str:
+        wrt = Variable(wrt)
+    if disk_cache is not None:
+        key = derivation_key(expr, wrt, hessian)
+        dexpr = disk_cache.get(key)
+        if dexpr is not None:
+            return dexpr
+    dexpr = massage2canonical(d(expr, wrt, hessian=hessian), verbose=False, cache=cache)
+    if disk_cache is not None:
+        disk_cache.put(key, dexpr)
+    return dexpr
+
+
+# Result of one job of canonical_differentials. error is the exception
+# raised by the job, if any, and warnings the list of warning messages.
+DerivationResult = collections.namedtuple("DerivationResult", ["dexpr", "error", "warnings"])
+
+# CanonicalCache of a worker process of canonical_differentials,
+# shared between the jobs run by the process.
+_worker_cache = None
+
+
+def _derive(job, disk_cache):
+    global _worker_cache
+    if _worker_cache is None:
+        _worker_cache = CanonicalCache()
+    expr, wrt = job[0], job[1]
+    hessian = job[2] if len(job) > 2 else False
+    dexpr = None
+    error = None
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        try:
+            dexpr = canonical_differential(expr, wrt, hessian, disk_cache=disk_cache,
+                                           cache=_worker_cache)
+        except Exception as e:
+            error = e
+    return DerivationResult(dexpr, error, [str(w.message) for w in caught])
+
+
+def canonical_differentials(jobs, workers=None, disk_cache=None):
+    """
+    Computes canonical_differential for each job on a pool of processes.
+
+    Args:
+      - jobs: Sequence of (expr, wrt) or (expr, wrt, hessian) tuples.
+
+    Keyword args:
+      - workers: Number of processes. Defaults to the number of CPUs.
+          With 0, the jobs are run in this process.
+      - disk_cache: DiskCache shared by the processes, see canonical_differential.
+
+    Returns a list of DerivationResult, in the order of jobs. A job that
+    fails, also in sending it to or from its process, does not stop the
+    others; its exception is returned as the error of its result.
+    Warnings are returned instead of shown.
+    """
+    jobs = list(jobs)
+    if workers == 0:
+        return [_derive(job, disk_cache) for job in jobs]
+    # Imported here, as it takes long to import.
+    import concurrent.futures
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_derive, job, disk_cache) for job in jobs]
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(DerivationResult(None, e, []))
+    return results
+
+
+def split_constant(expr):
+    """
+    Splits expr into a constant factor and the rest, e.g. 2A -> (2, A).
+    """
+    if isinstance(expr, ScalarMulExpr) and type(expr.children[0]) == Scalar:
+        return expr.children[0].value, expr.children[1]
+    return 1, expr
+
+
 def fix_structure(expr):
-    for i, c in enumerate(expr.children):
-        fix_structure(c)
-
-        if isinstance(c, MatMulExpr):
-            a, b = c.children
-            if isinstance(a, ScalarMulExpr) and isinstance(b, ScalarMulExpr):
-                c = ScalarMulExpr(a.children[0] * b.children[0], a.children[1] * b.children[1])
-                expr.children[i] = c
-            elif isinstance(a, ScalarMulExpr):
-                c = ScalarMulExpr(a.children[0], a.children[1] * b)
-                expr.children[i] = c
-            elif isinstance(b, ScalarMulExpr):
-                c = ScalarMulExpr(b.children[0], a * b.children[1])
-                expr.children[i] = c
-
-
-def massage2canonical_stage1(expr, cases, levels, mem, prev_case=None, return_matches=False):
-    # print(expr)
-    # print(type(expr))
-
-    # if expr in mem:
-    #     return mem[expr]
-
-    while True:
-        result = [massage2canonical_stage1(
-            child, cases, levels+[child_index+1], mem, prev_case, return_matches=True) for child_index, child in enumerate(expr.children)]
-        expr.children = [a for a, b in result]
-        child_had_matches = any([b for a, b in result])
-        fix_structure(expr)
-        if not child_had_matches:
-            break
-
-    fix_structure(expr)
-
-    had_matches = False
-    while True:
-        expr = copy.deepcopy(expr)
-        prev_expr = copy.deepcopy(expr)
-        matches = match_deepest(expr, cases.keys())
-        if len(matches) > 0:
-            best_case = matches.pop(0)
-            if prev_case is not None and len(matches) > 0:
-                while cases[best_case] == prev_case:
-                    best_case = matches.pop(0)
-        if len(matches) > 0:
-            had_matches = True
-
-            expr = translate_case(expr, best_case, cases[best_case])
-            # print_structure(prev_expr)
-            # print_structure(expr)
-            new_expr_copy = copy.deepcopy(expr)
-            # print "Matches:,matches
-            if CANONICAL_VERBOSE:
-                print("[{}] Applying {} -> {}".format(".".join(map(str,
-                                                                   levels)), best_case, cases[best_case]))
-                print("[{}] :: {} -> {}".format(".".join(map(str, levels)),
-                                                prev_expr, new_expr_copy))
-
-            expr.children = [massage2canonical_stage1(
-                child, cases, levels+[1], mem, cases[best_case] if prev_case is not None else None) for child_index, child in enumerate(expr.children)]
-            levels[-1] += 1
-            expr = massage2canonical_stage1(expr, cases, levels, mem, cases[best_case] if prev_case is not None else None)
-            mem[prev_expr] = expr
+    """
+    Pulls scalar factors out of a product, e.g. A*(sB) -> s(AB),
+    combines nested constant factors, e.g. 0.5(2A) -> 1.0A,
+    and like terms, e.g. A+2A -> 3A, and drops zero terms, e.g. Tr(0).
+    Returns expr itself if there is nothing to fix.
+    """
+    if isinstance(expr, ScalarMulExpr):
+        a, b = expr.children
+        if type(a) == Scalar and type(b) == ScalarMulExpr and type(b.children[0]) == Scalar:
+            return ScalarMulExpr(a * b.children[0], b.children[1])
+    elif isinstance(expr, MatMulExpr):
+        a, b = expr.children
+        if isinstance(a, ScalarMulExpr) and isinstance(b, ScalarMulExpr):
+            return ScalarMulExpr(a.children[0] * b.children[0], a.children[1] * b.children[1])
+        elif isinstance(a, ScalarMulExpr):
+            return ScalarMulExpr(a.children[0], a.children[1] * b)
+        elif isinstance(b, ScalarMulExpr):
+            return ScalarMulExpr(b.children[0], a * b.children[1])
+    elif isinstance(expr, TraceExpr) and type(expr.children[0]) == NullExpr:
+        return expr.children[0]
+    elif isinstance(expr, (AddExpr, SubExpr)):
+        (a_value, a), (b_value, b) = map(split_constant, expr.children)
+        if a == b:
+            if isinstance(expr, AddExpr):
+                value = a_value + b_value
+            else:
+                value = a_value - b_value
+            if value == 0:
+                return NullExpr()
+            return Scalar(value) * a
+        elif type(b) == NullExpr:
+            return expr.children[0]
+        elif type(a) == NullExpr:
+            return expr.children[1] if isinstance(expr, AddExpr) else -expr.children[1]
+    return expr
+
+
+def _coefficient(expr):
+    """
+    Splits a flattened expr into a constant coefficient and the rest,
+    e.g. 2A -> (2, A) and 3 -> (3, 1).
+    """
+    if isinstance(expr, SumExpr) and len(expr.children) == 1:
+        return expr.coefficients[0], expr.children[0]
+    elif type(expr) == Scalar:
+        return expr.value, Scalar(1)
+    return 1, expr
+
+
+def _scale(coefficient, expr):
+    """
+    Returns coefficient times the flattened expr.
+    """
+    if type(expr) == Scalar:
+        return Scalar(coefficient * expr.value)
+    return make_sum((coefficient,), (expr,))
+
+
+def _flat_sum(coefficients, children, digests):
+    # term -> coefficient, so that like terms are combined in one pass.
+    terms = {}
+    for sign, child in zip(coefficients, children):
+        if isinstance(child, SumExpr):
+            pairs = zip(child.coefficients, child.children)
         else:
-            break
+            pairs = [_coefficient(child)]
+        for c, term in pairs:
+            if type(term) != NullExpr:
+                terms[term] = terms.get(term, 0) + sign * c
+    order = sorted(terms, key=lambda term: fingerprint(term, digests))
+    if len(order) == 1:
+        return _scale(terms[order[0]], order[0])
+    return make_sum([terms[term] for term in order], order)
 
-    fix_structure(expr)
 
-    if return_matches:
-        return expr, had_matches
-    else:
-        return expr
+def _flat_product(children):
+    coefficient = 1
+    scalars = []
+    factors = []
+    for child in children:
+        c, child = _coefficient(child)
+        coefficient = coefficient * c
+        for f in child.children if isinstance(child, ProductExpr) else [child]:
+            if type(f) == ScalarVariable:
+                # Scalar factors commute, so they are put first.
+                scalars.append(f)
+            elif type(f) == NullExpr:
+                return NullExpr()
+            elif f != Scalar(1):
+                factors.append(f)
+    scalars.sort(key=lambda f: f.name)
+    return _scale(coefficient, make_product(scalars + factors))
+
+
+def _sum_terms(expr):
+    """
+    Returns the (coefficient, term) pairs of a chain of sums,
+    e.g. A-(B+C) -> [(1, A), (-1, B), (-1, C)].
+    """
+    terms = []
+    todo = [(1, expr)]
+    while len(todo) > 0:
+        c, e = todo.pop()
+        if isinstance(e, AddExpr):
+            todo.extend(((c, e.children[1]), (c, e.children[0])))
+        elif isinstance(e, SubExpr):
+            todo.extend(((-c, e.children[1]), (c, e.children[0])))
+        elif isinstance(e, SumExpr):
+            todo.extend((c * k, t) for k, t in reversed(list(zip(e.coefficients, e.children))))
+        else:
+            terms.append((c, e))
+    return terms
+
+
+def _product_factors(expr):
+    """
+    Returns the factors of a chain of products, e.g. (2A)(BC) -> [2, A, B, C].
+    """
+    factors = []
+    todo = [expr]
+    while len(todo) > 0:
+        e = todo.pop()
+        if isinstance(e, (ScalarMulExpr, MatMulExpr, ProductExpr)):
+            todo.extend(reversed(e.children))
+        else:
+            factors.append(e)
+    return factors
+
+
+def flatten(expr):
+    """
+    Returns expr with its sums and products flattened into SumExpr and
+    ProductExpr nodes, e.g. (A+B)-(A-2C) -> B+2C and (2A)(BC) -> 2ABC.
+
+    Like terms are combined and constant factors are collected into the
+    coefficients of the sums. The terms of each sum are put in a fixed
+    order, by their fingerprint, and the scalar variables of each product
+    in front, by name. Expressions that only differ by the associativity
+    of their sums and products, or by the order of their terms, are thus
+    flattened to the same node. Each chain of sums or products is
+    collected at once from its top rather than node by node, so this
+    takes linear time also for long chains.
+    """
+    digests = {}
+    mem = {}
+    # Node -> (coefficients, operands) of the node, while it is pending.
+    chains = {}
+    todo = [expr]
+    while len(todo) > 0:
+        e = todo[-1]
+        if e in mem:
+            todo.pop()
+            continue
+        if e not in chains:
+            if isinstance(e, (AddExpr, SubExpr, SumExpr)):
+                terms = _sum_terms(e)
+                chains[e] = ([c for c, _ in terms], [t for _, t in terms])
+            elif isinstance(e, (ScalarMulExpr, MatMulExpr, ProductExpr)):
+                chains[e] = (None, _product_factors(e))
+            else:
+                chains[e] = (None, e.children)
+        coefficients, operands = chains[e]
+        pending = [c for c in operands if c not in mem]
+        if len(pending) > 0:
+            todo.extend(pending)
+            continue
+        todo.pop()
+        del chains[e]
+        children = [mem[c] for c in operands]
+        if isinstance(e, (AddExpr, SubExpr, SumExpr)):
+            mem[e] = _flat_sum(coefficients, children, digests)
+        elif isinstance(e, (ScalarMulExpr, MatMulExpr, ProductExpr)):
+            mem[e] = _flat_product(children)
+        elif isinstance(e, TraceExpr):
+            # Tr(2A) -> 2Tr(A)
+            c, child = _coefficient(children[0])
+            mem[e] = _scale(c, TraceExpr(child) if type(child) != NullExpr else child)
+        elif isinstance(e, TransposeExpr):
+            # (2A)' -> 2A'
+            c, child = _coefficient(children[0])
+            mem[e] = _scale(c, child.T)
+        else:
+            mem[e] = e.with_children(children)
+    return mem[expr]
+
+
+def unflatten(expr):
+    """
+    Returns expr with its SumExpr and ProductExpr nodes written with
+    the binary operators, from left to right, as they are matched by
+    the rules of massage2canonical. E.g. products become left
+    associative, (AB)C.
+    """
+    mem = {}
+    todo = [expr]
+    while len(todo) > 0:
+        e = todo[-1]
+        if e in mem:
+            todo.pop()
+            continue
+        pending = [c for c in e.children if c not in mem]
+        if len(pending) > 0:
+            todo.extend(pending)
+            continue
+        todo.pop()
+        children = [mem[c] for c in e.children]
+        if isinstance(e, SumExpr):
+            # Start with a positive term if possible, e.g. Y-DX rather than -DX+Y.
+            pairs = list(zip(e.coefficients, children))
+            first = next((i for i, (c, _) in enumerate(pairs)
+                          if not (isinstance(c, (int, float)) and c < 0)), 0)
+            pairs.insert(0, pairs.pop(first))
+            result = None
+            for c, term in pairs:
+                negative = isinstance(c, (int, float)) and c < 0
+                if negative and result is not None:
+                    result = result - (term if c == -1 else -c * term)
+                elif c == -1:
+                    result = -term if result is None else result + -term
+                else:
+                    term = term if c == 1 else c * term
+                    result = term if result is None else result + term
+            mem[e] = result
+        elif isinstance(e, ProductExpr):
+            result = children[0]
+            for factor in children[1:]:
+                result = result * factor
+            mem[e] = result
+        else:
+            mem[e] = e.with_children(children)
+    return mem[expr]
+
+
+def massage2canonical_stage1(expr, rules, mem=None, cache=None):
+    """
+    Rewrites expr with the given RuleSet until no rule applies anywhere.
+
+    Nodes are processed from a worklist, children first. Once the children
+    of a node are in normal form, scalar factors are pulled out of it and
+    the deepest matching rule is applied. Only the new nodes built by a
+    rewrite are dirty and put back on the worklist, since the subtrees
+    substituted into them are already in normal form. The cost is thus
+    proportional to the number of rewrites, not to the size of the tree.
+
+    A rewrite that leads back to a node that is still being rewritten
+    would loop, so such rewrites are skipped, and a node that is reached
+    again through its own rewrites is taken as its normal form.
+
+    Keyword args:
+      - mem: Dict mapping node -> normal form, which is filled in
+          for every node that is processed.
+      - cache: CanonicalCache to look up normal forms in, and to store
+          them to, so that they can be reused by later calls.
+    """
+    if mem is None:
+        mem = {}
+
+    def resolve(node, normal_node):
+        mem[node] = normal_node
+        if cache is not None:
+            cache.put_canonical(rules, node, normal_node)
+
+    # node -> node it was rewritten to, for nodes whose rewrite
+    # has not reached normal form yet.
+    forward = {}
+    num_rewrites = 0
+    todo = [expr]
+    while len(todo) > 0:
+        node = todo[-1]
+        if node in mem:
+            todo.pop()
+            continue
+        if node in forward:
+            target = forward[node]
+            if target in mem:
+                todo.pop()
+                del forward[node]
+                resolve(node, mem[target])
+            else:
+                todo.append(target)
+            continue
+        if cache is not None:
+            normal_node = cache.get_canonical(rules, node)
+            if normal_node is not None:
+                todo.pop()
+                mem[node] = normal_node
+                continue
+        pending = [c for c in node.children if c not in mem]
+        if len(pending) > 0:
+            todo.extend(reversed(pending))
+            continue
+
+        new_node = node.with_children([mem[c] for c in node.children])
+        if new_node in forward:
+            # The rewrites of new_node led back to itself. Break the
+            # cycle by taking new_node as the normal form.
+            todo.pop()
+            resolve(node, new_node)
+            continue
+        target = fix_structure(new_node)
+        if target is new_node:
+            target = None
+            for case in match_deepest(new_node, rules.index):
+                rewritten = translate_case(new_node, case, rules.cases[case])
+                if rewritten is new_node or is_cyclic(rewritten, forward, mem):
+                    continue
+                target = rewritten
+                if CANONICAL_VERBOSE:
+                    print("[{}] Applying {} -> {}".format(
+                        num_rewrites + 1, case, rules.cases[case]))
+                    print("[{}] :: {} -> {}".format(
+                        num_rewrites + 1, new_node.short_str(), rewritten.short_str()))
+                break
+        if target is None:
+            # Fixed point.
+            todo.pop()
+            resolve(node, new_node)
+            if new_node is not node:
+                resolve(new_node, new_node)
+        else:
+            num_rewrites += 1
+            forward[node] = target
+            todo.append(target)
+
+    return mem[expr]
+
+
+def is_cyclic(expr, forward, mem):
+    """
+    True if expr contains a node that is still being rewritten.
+    Subtrees already in normal form are not searched.
+    """
+    todo = [expr]
+    while len(todo) > 0:
+        e = todo.pop()
+        if e in forward:
+            return True
+        todo.extend(c for c in e.children if c not in mem)
+    return False
 
 
 def is_canonical(expr):
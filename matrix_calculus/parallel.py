@@ -0,0 +1,149 @@
+"""
+Parallel evaluation of independent subexpressions on a thread pool.
+
+NumPy releases the GIL in BLAS calls and most array operations, so the
+independent terms of e.g. a sum of large matrix products can be
+computed at the same time. Every operation is started as soon as its
+operands are ready. Note that BLAS may itself use several threads per
+operation, in which case fewer workers can be faster.
+
+@author Tommi Kerola
+
+"""
+
+import concurrent.futures
+import os
+
+
+def run_graph(executor, nodes, operands, compute, inline=None):
+    """
+    Computes the value of every node, running nodes whose operands are
+    ready in parallel on executor.
+
+    Args:
+      - nodes: The nodes, with the operands of each node before it.
+      - operands: Function returning the operands of a node.
+      - compute: Function of a node and the dict of values, in which
+          the values of the operands of the node are set, returning
+          the value of the node.
+
+    Keyword args:
+      - inline: Function returning whether a node is cheap enough to be
+          computed in the calling thread rather than on executor.
+
+    Returns a dict mapping the nodes to their values.
+    """
+    users = {}
+    waiting = {}
+    for n in nodes:
+        deps = set(operands(n))
+        waiting[n] = len(deps)
+        for o in deps:
+            users.setdefault(o, []).append(n)
+
+    values = {}
+    ready = [n for n in nodes if waiting[n] == 0]
+    running = {}
+
+    def finish(n, value):
+        values[n] = value
+        for u in users.get(n, ()):
+            waiting[u] -= 1
+            if waiting[u] == 0:
+                ready.append(u)
+
+    while len(ready) > 0 or len(running) > 0:
+        while len(ready) > 0:
+            n = ready.pop()
+            if inline is not None and inline(n):
+                finish(n, compute(n, values))
+            else:
+                running[executor.submit(compute, n, values)] = n
+        if len(running) == 0:
+            break
+        finished, _ = concurrent.futures.wait(
+            running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in finished:
+            # Raises the exception of the operation, if any.
+            finish(running.pop(future), future.result())
+    return values
+
+
+class ParallelEvaluator(object):
+    """
+    Evaluates expressions on a pool of threads.
+
+    Keyword args:
+      - workers: Number of threads. Defaults to the number of CPUs.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+
+    def eval_exprs(self, outputs, x, wrt, const_dict, batched=False):
+        """
+        Evaluates several expressions like Expr.eval, computing
+        independent subexpressions, also of different expressions,
+        in parallel. Returns the list of their values.
+
+        Args:
+          - outputs: Sequence of (expr, is_grad) pairs.
+        """
+        # The nodes are (subexpression, is_grad) pairs.
+        nodes = []
+        seen = set()
+        todo = list(reversed(outputs))
+        while len(todo) > 0:
+            n = todo[-1]
+            if n in seen:
+                todo.pop()
+                continue
+            e, is_grad = n
+            pending = [(c, is_grad) for c in e.operands() if (c, is_grad) not in seen]
+            if len(pending) > 0:
+                todo.extend(reversed(pending))
+                continue
+            todo.pop()
+            seen.add(n)
+            nodes.append(n)
+
+        def operands(n):
+            return [(c, n[1]) for c in n[0].operands()]
+
+        def compute(n, values):
+            e, is_grad = n
+            args = [values[c, is_grad] for c in e.operands()]
+            return e.eval_node(args, x, wrt, const_dict, is_grad, batched)
+
+        def inline(n):
+            # Variables and constants.
+            return len(n[0].children) == 0
+
+        values = run_graph(self.executor, nodes, operands, compute, inline)
+        return [e.finish_eval(values[e, is_grad], batched) for e, is_grad in outputs]
+
+    def eval(self, expr, x, wrt, const_dict, is_grad=False, batched=False):
+        """
+        Evaluates expr like Expr.eval, computing independent
+        subexpressions in parallel.
+        """
+        return self.eval_exprs([(expr, is_grad)], x, wrt, const_dict, batched)[0]
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def parallel_eval(expr, x, wrt, const_dict, is_grad=False, batched=False, workers=None):
+    """
+    Evaluates expr like Expr.eval on a new pool of workers threads.
+    Use a ParallelEvaluator to keep the pool between evaluations.
+    """
+    with ParallelEvaluator(workers) as evaluator:
+        return evaluator.eval(expr, x, wrt, const_dict, is_grad, batched)
@@ -0,0 +1,170 @@
+"""
+Parser of matrix expressions in text form.
+
+The grammar, from the tightest to the loosest binding operators, as in
+the precedence table of Expr:
+
+  operand:   number, name, Tr(expr) or (expr)
+  postfix:   transpose A' or A.T, inverse A^-1 or A^(-1)
+  prefix:    unary plus and minus
+  product:   A*B
+  sum:       A+B, A-B, from left to right
+
+E.g. "Tr((Y-D*X)'*(Y-D*X))". Names that start with a lowercase letter
+are scalar variables, and other names are matrix variables, unless
+the scalar variables are given explicitly.
+
+The expression is built with the same operators as Python code would,
+e.g. Expr.__mul__, so it equals the one built by hand. The parser is an
+operator precedence parser with explicit stacks, which takes linear time
+and does not recurse, however deeply the expression is nested.
+
+@author Tommi Kerola
+
+"""
+
+import re
+
+from matrix_calculus.cache import LRUCache
+from matrix_calculus.matrix_expr import Scalar, ScalarVariable, TraceExpr, Variable
+
+_TOKEN = re.compile(r"""\s*(?:
+    (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+  | (?P<trace>Tr\s*\()
+  | (?P<name>[A-Za-z_][A-Za-z_0-9]*)
+  | (?P<transpose>'|\.T(?![A-Za-z_0-9]))
+  | (?P<inverse>\^\s*(?:-\s*1|\(\s*-\s*1\s*\)))
+  | (?P<op>[-+*()])
+)""", re.VERBOSE)
+
+# Precedence levels of the binary and prefix operators, see Expr.
+_PRECEDENCE = {
+    "neg": 2,
+    "pos": 2,
+    "*": 3,
+    "+": 4,
+    "-": 4,
+}
+
+# Parsed expressions, keyed on the string and the scalar variable names.
+PARSE_CACHE = LRUCache(maxsize=1024)
+
+
+def _apply(op, operands):
+    b = operands.pop()
+    if op == "neg":
+        # Negative numbers are numbers rather than products with -1.
+        operands.append(Scalar(-b.value) if type(b) == Scalar else -b)
+    elif op == "pos":
+        operands.append(b)
+    else:
+        a = operands.pop()
+        if op == "*":
+            operands.append(a * b)
+        elif op == "+":
+            operands.append(a + b)
+        else:
+            operands.append(a - b)
+
+
+def _number(text):
+    try:
+        return Scalar(int(text))
+    except ValueError:
+        return Scalar(float(text))
+
+
+def _error(s, pos, message):
+    return ValueError("{} at position {} in \"{}\".".format(message, pos, s))
+
+
+def parse(s, scalars=None):
+    """
+    Parses the expression s.
+
+    Keyword args:
+      - scalars: Names of the scalar variables. By default, the names
+          that start with a lowercase letter.
+
+    Raises:
+      - ValueError: If s is not a valid expression.
+    """
+    # Operands, and operators and open brackets that are not yet applied.
+    operands = []
+    ops = []
+    expect_operand = True
+    pos = 0
+    while pos < len(s):
+        m = _TOKEN.match(s, pos)
+        if m is None:
+            if s[pos:].isspace():
+                break
+            raise _error(s, pos, "Unexpected character")
+        kind = m.lastgroup
+        text = m.group(kind)
+        start = m.start(kind)
+        pos = m.end()
+
+        if expect_operand:
+            if kind == "number":
+                operands.append(_number(text))
+            elif kind == "name":
+                if scalars is not None and text in scalars or \
+                        scalars is None and text[0].islower():
+                    operands.append(ScalarVariable(text))
+                else:
+                    operands.append(Variable(text))
+            elif kind == "trace":
+                ops.append("Tr(")
+                continue
+            elif text == "(":
+                ops.append("(")
+                continue
+            elif text in ("+", "-"):
+                ops.append("neg" if text == "-" else "pos")
+                continue
+            else:
+                raise _error(s, start, "Expected an operand")
+            expect_operand = False
+        elif kind == "transpose":
+            operands[-1] = operands[-1].T
+        elif kind == "inverse":
+            operands[-1] = operands[-1] ** -1
+        elif text in ("*", "+", "-"):
+            precedence = _PRECEDENCE[text]
+            # All operators are left associative.
+            while len(ops) > 0 and _PRECEDENCE.get(ops[-1], precedence + 1) <= precedence:
+                _apply(ops.pop(), operands)
+            ops.append(text)
+            expect_operand = True
+        elif text == ")":
+            while len(ops) > 0 and ops[-1] in _PRECEDENCE:
+                _apply(ops.pop(), operands)
+            if len(ops) == 0:
+                raise _error(s, start, "Unmatched \")\"")
+            if ops.pop() == "Tr(":
+                operands[-1] = TraceExpr(operands[-1])
+        else:
+            raise _error(s, start, "Expected an operator")
+
+    if expect_operand:
+        raise _error(s, pos, "Expected an operand")
+    while len(ops) > 0:
+        op = ops.pop()
+        if op not in _PRECEDENCE:
+            raise _error(s, pos, "Missing \")\"")
+        _apply(op, operands)
+    return operands[0]
+
+
+def from_string(s, scalars=None):
+    """
+    Parses the expression s like parse, with the results of
+    previous calls taken from PARSE_CACHE.
+    """
+    key = (s, None if scalars is None else frozenset(scalars))
+    expr = PARSE_CACHE.get(key)
+    if expr is None:
+        expr = parse(s, scalars)
+        PARSE_CACHE.put(key, expr)
+    return expr
@@ -0,0 +1,204 @@
+"""
+Compact binary serialization of matrix expressions.
+
+An expression is stored as a flat table of its distinct nodes in
+post-order, so shared subtrees are only stored once and no recursion
+is needed to read or write deep expressions.
+
+Format (all integers are little endian):
+
+    magic       b"MCX"
+    version     uint8
+    counts      uint32 number of strings, values and node words
+    strings     per string: uint32 length, utf-8 bytes
+    values      per value: uint8 kind, then an int64 or float64,
+                or a uint32 length and a pickle for other kinds
+    nodes       uint32 words: a type code followed by its operands
+
+The operands of a node are indices into the strings (names and symbols),
+the values (Scalar values and coefficients) or the preceding nodes
+(children). Nodes with any number of children, e.g. SumExpr, store
+their count followed by their indices. The last node is the root.
+
+@author Tommi Kerola
+
+"""
+
+import array
+import pickle
+import struct
+import sys
+
+from matrix_calculus.matrix_expr import *
+
+MAGIC = b"MCX"
+VERSION = 1
+
+# Operand kinds. _EXPRS stands for all the remaining operands, which are
+# children.
+_EXPR, _STRING, _VALUE, _EXPRS = range(4)
+
+# Value kinds.
+_INT, _FLOAT, _PICKLE = range(3)
+
+# Type code -> (class, operand kinds). The codes are part of the format
+# and must never be reordered.
+_NODE_TYPES = [
+    (NullExpr, ()),
+    (Variable, (_STRING,)),
+    (ScalarVariable, (_STRING,)),
+    (Scalar, (_VALUE,)),
+    (DifferentialExpr, (_EXPR, _EXPR)),
+    (AddExpr, (_EXPR, _EXPR)),
+    (SubExpr, (_EXPR, _EXPR)),
+    (ScalarMulExpr, (_EXPR, _EXPR)),
+    (MatMulExpr, (_EXPR, _EXPR)),
+    (TraceExpr, (_EXPR,)),
+    (StarExpr, (_EXPR, _STRING)),
+    (InverseExpr, (_EXPR,)),
+    (TransposeExpr, (_EXPR,)),
+    (FactorizationExpr, (_EXPR,)),
+    (SumExpr, (_VALUE, _EXPRS)),
+    (ProductExpr, (_EXPRS,)),
+]
+_TYPE_CODES = dict((cls, code) for code, (cls, _) in enumerate(_NODE_TYPES))
+
+_header = struct.Struct("<3sBIII")
+_uint32 = struct.Struct("<I")
+_int64 = struct.Struct("<Bq")
+_float64 = struct.Struct("<Bd")
+
+
+def _encode_value(value):
+    if type(value) == int and -2**63 <= value < 2**63:
+        return _int64.pack(_INT, value)
+    elif type(value) == float:
+        return _float64.pack(_FLOAT, value)
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    return struct.pack("<B", _PICKLE) + _uint32.pack(len(data)) + data
+
+
+def dumps(expr):
+    """
+    Serializes expr to bytes.
+    """
+    strings = []
+    string_index = {}
+    values = []
+    node_index = {}
+    words = array.array("I")
+
+    todo = [expr]
+    while len(todo) > 0:
+        e = todo[-1]
+        if id(e) in node_index:
+            todo.pop()
+            continue
+        args = e._args()
+        pending = [a for a in args if isinstance(a, Expr) and id(a) not in node_index]
+        if len(pending) > 0:
+            todo.extend(reversed(pending))
+            continue
+        todo.pop()
+
+        try:
+            code = _TYPE_CODES[type(e)]
+        except KeyError:
+            raise TypeError("Cannot serialize {}.".format(type(e).__name__))
+        words.append(code)
+        for k, kind in enumerate(_NODE_TYPES[code][1]):
+            if kind == _EXPRS:
+                words.append(len(args) - k)
+                words.extend(node_index[id(c)] for c in args[k:])
+                continue
+            a = args[k]
+            if kind == _EXPR:
+                words.append(node_index[id(a)])
+            elif kind == _STRING:
+                if a not in string_index:
+                    string_index[a] = len(strings)
+                    strings.append(a)
+                words.append(string_index[a])
+            else:
+                words.append(len(values))
+                values.append(_encode_value(a))
+        node_index[id(e)] = len(node_index)
+
+    parts = [_header.pack(MAGIC, VERSION, len(strings), len(values), len(words))]
+    for s in strings:
+        data = s.encode("utf-8")
+        parts.append(_uint32.pack(len(data)))
+        parts.append(data)
+    parts.extend(values)
+    if sys.byteorder != "little":
+        words.byteswap()
+    parts.append(words.tobytes())
+    return b"".join(parts)
+
+
+def loads(data):
+    """
+    Reads an expression serialized by dumps.
+
+    Raises:
+     - ValueError: If data is not a serialized expression of a supported version.
+    """
+    data = memoryview(data)
+    if len(data) < _header.size:
+        raise ValueError("Data is too short to be a serialized expression.")
+    magic, version, num_strings, num_values, num_words = _header.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Data is not a serialized expression.")
+    if version != VERSION:
+        raise ValueError(
+            "Unsupported serialization version {}, expected {}.".format(version, VERSION))
+    pos = _header.size
+
+    strings = []
+    for _ in range(num_strings):
+        (n,) = _uint32.unpack_from(data, pos)
+        pos += _uint32.size
+        strings.append(bytes(data[pos:pos + n]).decode("utf-8"))
+        pos += n
+
+    values = []
+    for _ in range(num_values):
+        kind = data[pos]
+        if kind == _INT:
+            values.append(_int64.unpack_from(data, pos)[1])
+            pos += _int64.size
+        elif kind == _FLOAT:
+            values.append(_float64.unpack_from(data, pos)[1])
+            pos += _float64.size
+        elif kind == _PICKLE:
+            (n,) = _uint32.unpack_from(data, pos + 1)
+            pos += 1 + _uint32.size
+            values.append(pickle.loads(data[pos:pos + n]))
+            pos += n
+        else:
+            raise ValueError("Unknown value kind {}.".format(kind))
+
+    words = array.array("I")
+    words.frombytes(data[pos:pos + num_words * words.itemsize])
+    if sys.byteorder != "little":
+        words.byteswap()
+
+    nodes = []
+    tables = (nodes, strings, values)
+    i = 0
+    while i < len(words):
+        cls, kinds = _NODE_TYPES[words[i]]
+        i += 1
+        args = []
+        for kind in kinds:
+            if kind == _EXPRS:
+                n = words[i]
+                args.extend(nodes[j] for j in words[i + 1:i + 1 + n])
+                i += 1 + n
+            else:
+                args.append(tables[kind][words[i]])
+                i += 1
+        nodes.append(cls(*args))
+    if len(nodes) == 0:
+        raise ValueError("Serialized expression contains no nodes.")
+    return nodes[-1]
@@ -1,9 +1,15 @@
 
-import matplotlib.pyplot as plt
+def _pyplot():
+    """
+    Returns matplotlib.pyplot, set up for rendering LaTeX.
+    It is only imported once something is shown, as it takes long.
+    """
+    import matplotlib.pyplot as plt
 
-plt.rc('text', usetex=True)
-plt.rc('font', family='serif', size=22)
-plt.rc('figure', facecolor='white')
+    plt.rc('text', usetex=True)
+    plt.rc('font', family='serif', size=22)
+    plt.rc('figure', facecolor='white')
+    return plt
 
 
 def show_latex(expr_grad, expr_orig=None, wrt=None, hessian=False):
@@ -26,6 +32,7 @@ def show_latex(expr_grad, expr_orig=None, wrt=None, hessian=False):
             wrt_latex_str = r"\partial{{{}}}".format(wrt.toLatex())
         latex_str = r"\frac{{ \partial{{{}}} }}{{ {} }} = ".format(
             expr_orig.toLatex(), wrt_latex_str) + latex_str
+    plt = _pyplot()
     #latex_str = r"$\frac{ \partial\|\mathbf{Y}-\mathbf{D}\mathbf{X}\|_2^2 }{\partial \mathbf{D}} = \mathbf{X} (\mathbf{Y}-\mathbf{D}}\mathbf{X})^T \partial \mathbf{D}$"
     plt.figtext(0.5, 0.5, "${}$".format(latex_str),
                 horizontalalignment='center')
@@ -0,0 +1,61 @@
+"""
+Support for scipy.sparse matrices in evaluation.
+
+Sparse operands are kept sparse through products, transposes and
+traces, and only the results that are dense anyway, e.g. the product of
+a sparse and a dense matrix, are dense. Sums of sparse and dense
+matrices are returned as ndarrays rather than np.matrix.
+
+scipy is optional; without it no value is sparse. As a sparse value can
+only have been made with scipy.sparse already imported, it is not
+imported here, which saves its import time when no value is sparse.
+
+@author Tommi Kerola
+
+"""
+
+import sys
+
+import numpy as np
+
+
+def issparse(a):
+    sp = sys.modules.get("scipy.sparse")
+    return sp is not None and sp.issparse(a)
+
+
+def _array(a):
+    # Operations of sparse matrices with ndarrays return np.matrix.
+    if isinstance(a, np.matrix):
+        return np.asarray(a)
+    return a
+
+
+def add(a, b):
+    return _array(a + b)
+
+
+def subtract(a, b):
+    return _array(a - b)
+
+
+def transpose(a):
+    if issparse(a):
+        return a.T
+    return np.transpose(a)
+
+
+def trace(a):
+    if issparse(a):
+        return a.trace()
+    return np.trace(a)
+
+
+def sparse_trace_dot(a, b):
+    """
+    Returns Tr(ab) = sum(a * b') for a or b sparse, touching only
+    the nonzero entries of the sparse one.
+    """
+    if issparse(a):
+        return a.multiply(transpose(b)).sum()
+    return b.multiply(transpose(a)).sum()
@@ -0,0 +1,35 @@
+"""
+Helpers shared by the tests.
+"""
+
+import numpy as np
+
+
+def constants(names="ABDY", n=3, **scalars):
+    """
+    Random n x n matrices for the variables with the given names,
+    and the given scalar variables.
+    """
+    rng = np.random.RandomState(0)
+    const_dict = dict((name, rng.randn(n, n)) for name in names)
+    const_dict.update(scalars)
+    return const_dict
+
+
+def point(n=3):
+    """
+    A well conditioned n x n matrix to evaluate expressions at.
+    """
+    return np.random.RandomState(1).randn(n, n) + n * np.eye(n)
+
+
+def numerical_gradient(expr, x, wrt, const_dict, eps=1e-6):
+    """
+    The gradient of expr with respect to wrt at x, by central differences.
+    """
+    grad = np.zeros_like(x)
+    for i in np.ndindex(*x.shape):
+        dx = np.zeros_like(x)
+        dx[i] = eps
+        grad[i] = (expr.eval(x + dx, wrt, const_dict) - expr.eval(x - dx, wrt, const_dict)) / (2 * eps)
+    return grad
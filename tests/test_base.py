@@ -0,0 +1,91 @@
+from matrix_calculus import *
+from matrix_calculus.base import _d_node, _differentiated_children
+
+
+def objective():
+    X = Variable("X")
+    Y = Variable("Y")
+    D = Variable("D")
+    return Tr((Y-D*X).T*(Y-D*X)), X
+
+
+def test_cache_is_shared_between_calls():
+    expr, X = objective()
+    cache = DiffCache()
+    dexpr = d(expr, X, cache=cache)
+    misses = cache.misses
+    assert d(expr, X, cache=cache) is dexpr
+    assert cache.misses == misses
+    assert cache.hits > 0
+
+
+def test_cache_does_not_change_the_result():
+    expr, X = objective()
+    assert d(expr, X, cache=DiffCache(maxsize=1)) == d(expr, X)
+    assert d(expr, X, hessian=True, cache=DiffCache(maxsize=1)) == d(expr, X, hessian=True)
+
+
+def test_cache_is_bounded():
+    expr, X = objective()
+    cache = DiffCache(maxsize=3)
+    d(expr, X, cache=cache)
+    assert len(cache) == 3
+
+
+def test_null_minus_expr_keeps_the_sign():
+    A = Variable("A")
+    assert NullExpr() - A == -A
+    assert A - NullExpr() is A
+
+
+def test_differential_of_a_difference():
+    A = Variable("A")
+    X = Variable("X")
+    assert d(A - X, X) == -DifferentialExpr(X, X)
+    assert d(X - A, X) == DifferentialExpr(X, X)
+
+
+def test_d_all_matches_d():
+    expr, X = objective()
+    dexprs = d_all(expr)
+    assert list(dexprs) == [Variable("Y"), Variable("D"), X]
+    for wrt, dexpr in dexprs.items():
+        assert dexpr == d(expr, wrt)
+    assert d_all(expr, ["X", "Z"]) == {X: d(expr, X), Variable("Z"): NullExpr()}
+
+
+def recursive_d(expr, wrt, cache):
+    # d() as it was before it used an explicit stack.
+    dexpr = cache.get_differential(expr, wrt)
+    if dexpr is None:
+        mem = dict((c, recursive_d(c, wrt, cache)) for c in _differentiated_children(expr))
+        dexpr = _d_node(expr, wrt, mem)
+        cache.put_differential(expr, wrt, dexpr)
+    return dexpr
+
+
+def test_cache_counts_are_those_of_recursive_d():
+    expr, X = objective()
+    cache = DiffCache()
+    d(expr, X, cache=cache)
+    assert (cache.misses, cache.hits, len(cache)) == (8, 1, 8)
+
+    A = Variable("A")
+    for expr in [expr, Tr(A*X.I*A*X.I), X*X + A*X*X, (X+A).T*(X+A)*(X+A)]:
+        for hessian in [False, True]:
+            cache = DiffCache()
+            expected_cache = DiffCache()
+            d(expr, X, hessian=hessian, cache=cache)
+            dexpr = recursive_d(expr, X, expected_cache)
+            if hessian:
+                recursive_d(dexpr.make_dx_constant(X), X, expected_cache)
+            assert (cache.misses, cache.hits, len(cache)) == \
+                (expected_cache.misses, expected_cache.hits, len(expected_cache))
+
+
+def test_deep_expression():
+    X = Variable("X")
+    expr = X
+    for i in range(10000):
+        expr = expr + Scalar(i) * X
+    assert d(expr, X).contains(DifferentialExpr)
@@ -0,0 +1,87 @@
+import pickle
+
+import matrix_calculus
+from matrix_calculus import *
+from matrix_calculus.matrix_massage import massage2canonical
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_structural_hash():
+    A = Variable("A")
+    B = Variable("B")
+    assert hash(A+B) != hash(B+A)
+    assert A+B != B+A
+    assert StarExpr(A, "*") != StarExpr(A, "'")
+    assert Scalar(2) != Scalar(3)
+
+
+def test_canonical_cache_is_reused():
+    X = Variable("X")
+    A = Variable("A")
+    cache = CanonicalCache()
+    dexpr = massage2canonical(d(Tr(A*X), X), verbose=False, cache=cache)
+    misses = cache.misses
+    assert massage2canonical(d(Tr(A*X), X), verbose=False, cache=cache) is dexpr
+    assert cache.misses == misses
+
+
+def test_fingerprint_is_structural():
+    A = Variable("A")
+    B = Variable("B")
+    assert fingerprint(A+B) == fingerprint(Variable("A")+Variable("B"))
+    assert fingerprint(A+B) != fingerprint(B+A)
+
+
+def test_package_exports_no_modules():
+    for name in ["os", "pickle", "hashlib", "tempfile", "collections", "warnings", "weakref"]:
+        assert not hasattr(matrix_calculus, name)
+
+
+class OldFormatEntry(object):
+    """
+    Pickles like an expression serialized with an unsupported version.
+    """
+
+    def __reduce__(self):
+        from matrix_calculus import serialize
+        data = bytearray(serialize.dumps(Variable("A")))
+        data[3] = 0
+        return (serialize.loads, (bytes(data),))
+
+
+def test_disk_cache_round_trip(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    expr = Tr(Variable("A")*Variable("X"))
+    cache.put("key", expr)
+    assert cache.get("key") is expr
+    assert cache.get("missing") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_disk_cache_is_bounded(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=1000)
+    for i in range(20):
+        cache.put(str(i), "x" * 200)
+    assert sum(p.stat().st_size for p in tmp_path.iterdir()) <= 1000
+    assert cache.get("19") == "x" * 200
+
+
+def test_disk_cache_drops_unreadable_entries(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    (tmp_path / ("old" + DiskCache.suffix)).write_bytes(pickle.dumps(OldFormatEntry()))
+    (tmp_path / ("truncated" + DiskCache.suffix)).write_bytes(pickle.dumps("value")[:-3])
+    assert cache.get("old") is None
+    assert cache.get("truncated") is None
+    assert cache.misses == 2
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,40 @@
+import numpy as np
+
+from matrix_calculus.chain import MULTIPLY, chain_plan, multiply_chain, trace_chain, trace_plan
+
+
+def test_chain_plan_multiplies_the_vector_first():
+    # X'(Xv) rather than (X'X)v for a tall X.
+    assert chain_plan(((3, 100), (100, 3), (3,))) == [0, 1, 2, MULTIPLY, MULTIPLY]
+    assert chain_plan(((3,), (3, 100), (100, 3))) == [0, 1, MULTIPLY, 2, MULTIPLY]
+
+
+def test_chain_plan_of_mismatched_shapes_is_left_to_right():
+    assert chain_plan(((2, 3), (4, 5))) == [0, 1, MULTIPLY]
+
+
+def test_multiply_chain_matches_np_dot():
+    rng = np.random.RandomState(0)
+    x = rng.randn(50, 3)
+    v = rng.randn(3)
+    a = rng.randn(3, 3)
+    np.testing.assert_allclose(multiply_chain([x.T, x, v]), x.T.dot(x).dot(v))
+    np.testing.assert_allclose(multiply_chain([2., x, a, 0.5, x.T]), x.dot(a).dot(x.T))
+    np.testing.assert_allclose(multiply_chain([v, x.T, x]), v.dot(x.T).dot(x))
+    assert multiply_chain([2., 3.]) == 6.
+
+
+def test_trace_plan_never_forms_the_square_product():
+    # Tr(R'R) for a tall R is one contraction of R with itself.
+    assert trace_plan(((3, 100), (100, 3))) in [([0], [1]), ([1], [0])]
+    assert trace_plan(((2, 3), (2, 3))) is None
+
+
+def test_trace_chain_matches_np_trace():
+    rng = np.random.RandomState(0)
+    r = rng.randn(50, 3)
+    a = rng.randn(3, 3)
+    b = rng.randn(3, 50)
+    np.testing.assert_allclose(trace_chain([r.T, r]), np.trace(r.T.dot(r)))
+    np.testing.assert_allclose(trace_chain([a, b, r, 2.]), 2 * np.trace(a.dot(b).dot(r)))
+    np.testing.assert_allclose(trace_chain([a]), np.trace(a))
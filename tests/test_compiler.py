@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+
+from matrix_calculus import *
+from matrix_calculus.compiler import COMPILE_CACHE, compile_expr, compile_exprs, \
+    compiled_function, compiled_value_and_grad, dot_shape
+from matrix_calculus.func import expr2func
+from matrix_calculus.matrix_massage import canonical_differential
+
+from helpers import constants, point
+
+A = Variable("A")
+B = Variable("B")
+D = Variable("D")
+X = Variable("X")
+Y = Variable("Y")
+s = ScalarVariable("s")
+
+EXPRS = [
+    Tr(A*X*B),
+    Tr((Y-D*X).T*(Y-D*X)),
+    (Y-D*X).T*(Y-D*X),
+    s*A*X + X.T*B,
+    Tr(A*X.I),
+    X.I*A - 2*X,
+    Tr(s*X),
+    make_sum((1, -2, 0.5), [A*X, X.T, Y]),
+    Tr(make_product([s, A, X, B])),
+]
+
+
+@pytest.mark.parametrize("expr", EXPRS)
+@pytest.mark.parametrize("is_grad", [False, True])
+def test_compiled_matches_eval(expr, is_grad):
+    const_dict = constants(s=0.5)
+    x = point()
+    f = compile_expr(expr, X, const_dict, is_grad, x.shape, x.dtype)
+    np.testing.assert_allclose(f(x), expr.eval(x, X, const_dict, is_grad))
+
+
+def test_expr2func_matches_eval():
+    const_dict = constants(s=0.5)
+    x = point()
+    for expr in EXPRS:
+        f = expr2func(expr, X, const_dict, wrt_shape=(3, 3))
+        np.testing.assert_allclose(f(x.ravel()), expr.eval(x, X, const_dict))
+
+
+def test_replaced_constants_are_used():
+    const_dict = {"A": 2 * np.eye(2)}
+    f = expr2func(Tr(A*X), X, const_dict)
+    x = np.eye(2)
+    assert f(x) == 4.
+    const_dict["A"] = 3 * np.eye(2)
+    assert f(x) == 6.
+    del const_dict["A"]
+    with pytest.raises(KeyError):
+        expr2func(Tr(A*X), X, const_dict)(x)
+
+
+def test_nodes_with_a_trace_are_not_shared_between_modes():
+    const_dict = constants(s=0.5)
+    x = point()
+    outputs = [(Tr(A*X), True), (Tr(A*X)*B, False), (Tr(A*X)*B, True)]
+    values = compile_exprs(outputs, X, const_dict, x.shape, x.dtype)(x)
+    for (expr, is_grad), value in zip(outputs, values):
+        np.testing.assert_allclose(value, expr.eval(x, X, const_dict, is_grad))
+
+
+def test_dot_shape_follows_np_dot():
+    for a, b in [((4, 3), (3, 2)), ((4, 3), (3,)), ((3,), (3, 2)), ((3,), (3,)), ((), (3, 2))]:
+        assert dot_shape(a, b) == np.dot(np.ones(a), np.ones(b)).shape
+    with pytest.raises(ValueError):
+        dot_shape((4, 3), (2,))
+
+
+@pytest.mark.parametrize("expr", EXPRS)
+def test_workspace_matches_eval(expr):
+    const_dict = constants(s=0.5)
+    x = point()
+    f = expr2func(expr, X, const_dict, workspace=True)
+    first = f(x)
+    np.testing.assert_allclose(first, expr.eval(x, X, const_dict))
+    # Later calls must not overwrite the results of earlier ones.
+    f(2 * x)
+    np.testing.assert_allclose(first, expr.eval(x, X, const_dict))
+    assert f.memory["workspace_bytes"] >= f.memory["peak_bytes"]
+
+
+@pytest.mark.parametrize("expr", [(Y-D*X).T*(Y-D*X), D.T*(Y-D*X), X.T*D.T*D*X + s*X.T*X])
+def test_workspace_with_a_vector_variable(expr):
+    rng = np.random.RandomState(0)
+    const_dict = {"Y": rng.randn(5), "D": rng.randn(5, 3), "s": 0.5}
+    x = rng.randn(3)
+    f = expr2func(expr, X, const_dict, workspace=True)
+    np.testing.assert_allclose(f(x), expr.eval(x, X, const_dict))
+
+
+
+def buffers(f):
+    # The workspace buffers are bound as the defaults of the args w<value>.
+    names = f.__code__.co_varnames[1:f.__code__.co_argcount]
+    return [a for name, a in zip(names, f.__defaults__) if name.startswith("w")]
+
+
+def test_functions_do_not_share_a_workspace():
+    const_dict = constants(s=0.5)
+    x = point()
+    expr = (Y-D*X).T*(Y-D*X)
+    dexpr = canonical_differential(Tr(expr), X)
+    for compile in [lambda: compiled_function(expr, X, const_dict, False, x, workspace=True),
+                    lambda: compiled_value_and_grad(Tr(expr), dexpr, X, const_dict, x,
+                                                    workspace=True)]:
+        hits = COMPILE_CACHE.hits
+        f = compile()
+        g = compile()
+        # The program is lowered once, but each function has its own workspace.
+        assert COMPILE_CACHE.hits == hits + 1
+        assert f is not g and f.memory is not g.memory
+        assert len(buffers(f)) > 0
+        for a in buffers(f):
+            assert not any(np.shares_memory(a, b) for b in buffers(g))
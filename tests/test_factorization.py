@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from matrix_calculus import *
+from matrix_calculus.factorization import Factorization, dot
+
+A = Variable("A")
+B = Variable("B")
+X = Variable("X")
+
+
+@pytest.mark.parametrize("a", [
+    np.array([[4., 1.], [1., 3.]]),
+    1e-9 * np.array([[2., 1.], [0., 2.]]),
+    np.array([[2., 1. + 1e-9], [1., 2.]]),
+    np.array([[0., 1.], [1., 0.]]),
+])
+def test_solves_match_the_inverse(a):
+    b = np.arange(6.).reshape(2, 3)
+    f = Factorization(a)
+    inverse = np.linalg.inv(a)
+    np.testing.assert_allclose(f.solve(b), inverse.dot(b), rtol=1e-12)
+    np.testing.assert_allclose(f.solve_left(b.T), b.T.dot(inverse), rtol=1e-12)
+    np.testing.assert_allclose(f.inverse(), inverse, rtol=1e-12)
+
+
+def test_only_symmetric_matrices_use_cholesky():
+    assert Factorization(np.array([[4., 1.], [1., 3.]]))._cholesky is not None
+    assert Factorization(1e-9 * np.array([[2., 1.], [0., 2.]]))._cholesky is None
+
+
+def test_trace_of_inverse():
+    a = 1e-9 * np.array([[2., 1.], [0., 2.]])
+    np.testing.assert_allclose(Tr(A.I).eval(None, X, {"A": a}), np.trace(np.linalg.inv(a)))
+
+
+def test_products_with_inverses_match_eval_of_the_inverse():
+    rng = np.random.RandomState(0)
+    a = rng.randn(3, 3) + 3 * np.eye(3)
+    b = rng.randn(3, 3)
+    const_dict = {"A": a, "B": b}
+    inverse = np.linalg.inv(a)
+    np.testing.assert_allclose((A.I*B).eval(None, X, const_dict), inverse.dot(b))
+    np.testing.assert_allclose((B*A.I).eval(None, X, const_dict), b.dot(inverse))
+    np.testing.assert_allclose(Tr(A.I*B*A.I).eval(None, X, const_dict),
+                               np.trace(inverse.dot(b).dot(inverse)))
+    np.testing.assert_allclose(dot(Factorization(a), b), inverse.dot(b))
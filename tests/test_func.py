@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from matrix_calculus import *
+from matrix_calculus.func import expr2func, expr2hvp, expr2value_and_grad
+from matrix_calculus.matrix_massage import canonical_differential
+
+from helpers import constants, numerical_gradient, point
+
+A = Variable("A")
+D = Variable("D")
+X = Variable("X")
+Y = Variable("Y")
+c = ScalarVariable("c")
+
+OBJECTIVES = [
+    Tr((Y-D*X).T*(Y-D*X)),
+    Tr(A*X.I),
+    Tr(c*X),
+    Tr(X),
+]
+
+
+@pytest.mark.parametrize("expr", OBJECTIVES)
+@pytest.mark.parametrize("options", [{}, {"workspace": True}, {"batched": True}])
+def test_value_and_grad(expr, options):
+    const_dict = constants("ADY", c=2.)
+    x = point()
+    f = expr2value_and_grad(expr, canonical_differential(expr, X), X, const_dict,
+                            wrt_shape=(3, 3), **options)
+    y, grad = f(x.ravel())
+    np.testing.assert_allclose(y, expr.eval(x, X, const_dict))
+    assert grad.shape == (9,)
+    np.testing.assert_allclose(grad.reshape(3, 3), numerical_gradient(expr, x, X, const_dict),
+                               rtol=1e-5, atol=1e-6)
+
+
+def test_scalar_gradient_needs_a_square_matrix():
+    f = expr2value_and_grad(Tr(c*X), canonical_differential(Tr(c*X), X), X, {"c": 2.})
+    with pytest.raises(ValueError):
+        f(np.ones((2, 3)))
+
+
+def test_batched_function_matches_the_function_of_each_item():
+    expr = Tr((Y-D*X).T*(Y-D*X))
+    const_dict = constants("ADY", c=2.)
+    xs = np.random.RandomState(2).randn(5, 9)
+    f = expr2func(expr, X, const_dict, wrt_shape=(3, 3))
+    batched = expr2func(expr, X, const_dict, wrt_shape=(3, 3), batched=True)
+    np.testing.assert_allclose(batched(xs), [f(x) for x in xs])
+
+
+@pytest.mark.parametrize("expr", [Tr((Y-D*X).T*(Y-D*X)), Tr(A*X.I), Tr(X.T*A*X)])
+def test_hvp_matches_differences_of_gradients(expr):
+    const_dict = constants("ADY", c=2.)
+    f = expr2value_and_grad(expr, canonical_differential(expr, X), X, const_dict, wrt_shape=(3, 3))
+    hvp = expr2hvp(canonical_differential(expr, X, hessian=True), X, const_dict, wrt_shape=(3, 3))
+    v = np.random.RandomState(3).randn(9)
+    eps = 1e-6
+    # Several directions at one x, and then another x.
+    for x, v in [(point(), v), (point(), 2 * v), (2 * point(), v)]:
+        x = x.ravel()
+        expected = (f(x + eps * v)[1] - f(x - eps * v)[1]) / (2 * eps)
+        np.testing.assert_allclose(hvp(x, v), expected, rtol=1e-5, atol=1e-6)
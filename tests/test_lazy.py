@@ -0,0 +1,25 @@
+import os
+import subprocess
+import sys
+
+from matrix_calculus.lazy import LazyModule
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def loaded_modules(code, modules):
+    code += "\nimport sys\nprint(' '.join(m for m in {!r} if m in sys.modules))".format(modules)
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.check_output([sys.executable, "-c", code], env=env).decode().split()
+
+
+def test_lazy_module_imports_on_first_use():
+    json = LazyModule("json")
+    assert json.dumps([1]) == "[1]"
+    assert "dumps" in vars(json)
+
+
+def test_symbolic_derivation_imports_no_numerical_libraries():
+    code = ("from matrix_calculus.matrix_massage import canonical_differential\n"
+            "canonical_differential(\"Tr((Y-D*X)'*(Y-D*X))\", \"X\", hessian=True)")
+    assert loaded_modules(code, ["numpy", "scipy", "matplotlib"]) == []
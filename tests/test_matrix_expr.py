@@ -0,0 +1,123 @@
+import copy
+import pickle
+
+import numpy as np
+import pytest
+
+from matrix_calculus import *
+
+
+def test_identical_nodes_are_shared():
+    A = Variable("A")
+    X = Variable("X")
+    assert Variable("A") is A
+    assert Tr(A*X) is Tr(Variable("A")*Variable("X"))
+    assert A*X is not X*A
+
+
+def test_copies_are_the_node_itself():
+    expr = Tr(Variable("A")*Variable("X").T)
+    assert copy.copy(expr) is expr
+    assert copy.deepcopy(expr) is expr
+
+
+def test_pickle_reinterns():
+    expr = Tr(Variable("A")*Variable("X").T)
+    assert pickle.loads(pickle.dumps(expr)) is expr
+
+
+def test_with_children_builds_a_new_node():
+    A = Variable("A")
+    B = Variable("B")
+    expr = A + B
+    assert expr.with_children([B, A]) is B + A
+    assert expr.children == (A, B)
+
+
+def test_make_dx_constant_does_not_mutate():
+    X = Variable("X")
+    A = Variable("A")
+    dexpr = d(Tr(A*X), X)
+    before = str(dexpr)
+    replaced = dexpr.make_dx_constant(X)
+    assert str(dexpr) == before
+    assert not replaced.contains(DifferentialExpr)
+
+
+def test_eval_computes_shared_subtrees_once():
+    X = Variable("X")
+    Y = Variable("Y")
+    D = Variable("D")
+    residual = Y - D*X
+    expr = Tr(residual.T*residual)
+    rng = np.random.RandomState(0)
+    const_dict = {"Y": rng.randn(3, 2), "D": rng.randn(3, 3)}
+    x = rng.randn(3, 2)
+    mem = {}
+    value = expr.eval(x, X, const_dict, mem=mem)
+    r = const_dict["Y"] - const_dict["D"].dot(x)
+    np.testing.assert_allclose(value, np.trace(r.T.dot(r)))
+    np.testing.assert_allclose(mem[residual], r)
+
+    # Values in mem are taken as they are.
+    mem = {residual: np.ones((3, 2))}
+    assert expr.eval(x, X, const_dict, mem=mem) == 6.
+
+
+def test_batched_eval_matches_eval_of_each_item():
+    X = Variable("X")
+    A = Variable("A")
+    Y = Variable("Y")
+    s = ScalarVariable("s")
+    rng = np.random.RandomState(0)
+    xs = rng.randn(4, 3, 3) + 3 * np.eye(3)
+    const_dict = {"A": rng.randn(3, 3), "Y": rng.randn(4, 3, 3), "s": rng.randn(4)}
+    for expr in [Tr((Y-A*X).T*(Y-A*X)), s*X.T*A, Tr(s*A*X.I), (Y-X).T]:
+        values = expr.eval(xs, X, const_dict, batched=True)
+        for i in range(4):
+            item_dict = {"A": const_dict["A"], "Y": const_dict["Y"][i], "s": const_dict["s"][i]}
+            np.testing.assert_allclose(values[i], expr.eval(xs[i], X, item_dict))
+
+
+def test_deep_expressions_need_no_recursion():
+    X = Variable("X")
+    left = X
+    right = Variable("X")
+    for i in range(20000):
+        left = left + Scalar(i) * X
+        right = right + Scalar(i) * X
+    assert left == right
+    assert len(left) == 80001
+    assert left.contains(Scalar)
+    assert not left.contains(TraceExpr)
+
+
+def test_nodes_have_no_dict():
+    A = Variable("A")
+    X = Variable("X")
+    for expr in [A, Scalar(2), NullExpr(), ScalarVariable("s"), A + X, A - X, A * X, 2 * A,
+                 Tr(A), A.T, A.I, StarExpr(A, "*"), DifferentialExpr(X, X),
+                 FactorizationExpr(A), make_sum((1, 2), [A, X]), make_product([A, X, A])]:
+        assert not hasattr(expr, "__dict__")
+        assert type(expr).precedence_level == expr.precedence_level
+    with pytest.raises(AttributeError):
+        A.extra = 1
+
+
+def deep_sum(n):
+    X = Variable("X")
+    expr = Tr(Variable("A0")*X)
+    for i in range(1, n):
+        expr = expr + Tr(Variable("A{}".format(i))*X)
+    return expr, X
+
+
+def test_deep_expressions_are_rendered_without_recursion():
+    expr, X = deep_sum(3000)
+    text = str(expr)
+    assert text.startswith("Tr(A0X)+Tr(A1X)+") and text.endswith("+Tr(A2999X)")
+    assert expr.toLatex().endswith(r"+{\mathrm{Tr}(\mathbf{A2999}\mathbf{X})}")
+    assert expr.short_str(max_depth=3) == "...+...+Tr(...)+Tr(......)"
+    assert expr.short_str().endswith("+Tr(A2995X)+Tr(A2996X)+Tr(A2997X)+Tr(A2998X)+Tr(A2999X)")
+    assert len(expr.short_str(max_depth=3000, max_length=20)) == 23
+    assert X.short_str() == "X"
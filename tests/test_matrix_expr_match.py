@@ -0,0 +1,28 @@
+from matrix_calculus import *
+from matrix_calculus.matrix_expr_match import CaseIndex, match_deepest, translate_case
+
+A = Variable("A")
+B = Variable("B")
+X = Variable("X")
+Y = Variable("Y")
+
+
+def test_index_matches_like_a_list_of_cases():
+    cases = [A*B, Tr(A*B), Tr(A), A+B, (A*B).T, A]
+    index = CaseIndex(cases)
+    for expr in [X*Y, Tr(X*Y), Tr(X+Y), X+Y, (X*Y).T, X.T, Y]:
+        assert match_deepest(expr, index) == match_deepest(expr, cases)
+
+
+def test_deepest_case_first():
+    assert match_deepest(Tr(X*Y), [Tr(A), Tr(A*B)]) == [Tr(A*B), Tr(A)]
+
+
+def test_index_skips_cases_of_other_types():
+    index = CaseIndex([A*B, A+B, Tr(A)])
+    assert match_deepest(Tr(X), index) == [Tr(A)]
+    assert index.num_attempts == 1
+
+
+def test_translate_case():
+    assert translate_case(Tr(X*Y.T), Tr(A*B.T), Tr(A.T*B)) == Tr(X.T*Y)
@@ -0,0 +1,158 @@
+import numpy as np
+import pytest
+
+from matrix_calculus import *
+from matrix_calculus.matrix_massage import canonical_differential, canonical_differential_all, \
+    canonical_differentials, fix_structure, flatten, massage2canonical, unflatten
+
+from helpers import constants, numerical_gradient, point
+
+A = Variable("A")
+B = Variable("B")
+D = Variable("D")
+X = Variable("X")
+Y = Variable("Y")
+
+OBJECTIVES = [
+    Tr(A*X*B),
+    Tr((Y-D*X).T*(Y-D*X)),
+    Tr(X.T*A*X),
+    Tr(A*X.I),
+    Tr(X*X.T),
+]
+
+
+@pytest.mark.parametrize("expr", OBJECTIVES)
+def test_canonical_form_gives_the_gradient(expr):
+    dexpr = massage2canonical(d(expr, X), verbose=False)
+    const_dict = constants()
+    x = point()
+    grad = dexpr.eval(x, X, const_dict, is_grad=True).T
+    np.testing.assert_allclose(grad, numerical_gradient(expr, x, X, const_dict), rtol=1e-5, atol=1e-6)
+
+
+def test_canonical_form_has_dx_on_the_right():
+    dexpr = massage2canonical(d(Tr(A*X*B), X), verbose=False)
+    assert dexpr == Tr(B*A*DifferentialExpr(X, X))
+
+
+def test_canonical_form_is_a_fixed_point():
+    for expr in OBJECTIVES:
+        dexpr = massage2canonical(d(expr, X), verbose=False)
+        assert massage2canonical(dexpr, verbose=False) is dexpr
+
+
+def test_canonical_form_does_not_depend_on_associativity():
+    C = Variable("C")
+    dexpr = massage2canonical(d(Tr((A*X)*(B*(X*C))), X), verbose=False)
+    assert massage2canonical(d(Tr(A*((X*B)*X)*C), X), verbose=False) is dexpr
+    assert massage2canonical(d(Tr(X.T*X*X.T*X), X), verbose=False) == \
+        massage2canonical(d(Tr((X.T*X)*(X.T*X)), X), verbose=False)
+
+
+def test_canonical_differential_disk_cache(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    expr = "Tr((Y-D*X)'*(Y-D*X))"
+    dexpr = canonical_differential(expr, "X", disk_cache=cache)
+    assert dexpr == canonical_differential(Tr((Y-D*X).T*(Y-D*X)), X)
+    assert canonical_differential(expr, "X", disk_cache=cache) is dexpr
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert canonical_differential(expr, "X", hessian=True, disk_cache=cache) == \
+        canonical_differential(expr, X, hessian=True)
+
+
+def test_fix_structure_combines_like_terms():
+    assert fix_structure(AddExpr(A, 2*A)) == 3*A
+    assert fix_structure(SubExpr(2*A, A)) == 1*A
+    assert fix_structure(SubExpr(2*A, 2*A)) == NullExpr()
+    assert fix_structure(SubExpr(NullExpr(), A)) == -A
+    assert fix_structure(AddExpr(A, NullExpr())) is A
+    assert fix_structure(A + B) is A + B
+
+
+def test_canonical_differential_of_a_difference():
+    assert canonical_differential(Tr(A - X), X) == -Tr(DifferentialExpr(X, X))
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_canonical_differentials(workers):
+    jobs = [(expr, X) for expr in OBJECTIVES] + [(OBJECTIVES[1], X, True), ("Tr(", "X")]
+    results = canonical_differentials(jobs, workers=workers)
+    assert len(results) == len(jobs)
+    for job, result in zip(jobs[:-1], results):
+        assert result.error is None
+        assert result.dexpr == canonical_differential(*job)
+    assert isinstance(results[-1].error, ValueError)
+    assert results[-1].dexpr is None
+
+
+def test_canonical_differentials_record_warnings():
+    result, = canonical_differentials([(Tr(FactorizationExpr(X)), X)], workers=0)
+    assert result.error is None
+    assert len(result.warnings) == 1
+
+
+def test_canonical_differential_all():
+    expr = Tr((Y-D*X).T*(Y-D*X))
+    const_dict = constants()
+    x = point()
+    const_dict["X"] = x
+    for wrt, dexpr in canonical_differential_all(expr).items():
+        expected = canonical_differential(expr, wrt)
+        value = const_dict[wrt.name]
+        np.testing.assert_allclose(dexpr.eval(value, wrt, const_dict, is_grad=True),
+                                   expected.eval(value, wrt, const_dict, is_grad=True))
+
+
+def test_flatten_is_a_normal_form():
+    C = Variable("C")
+    s = ScalarVariable("s")
+    assert flatten((A+B)-(A-2*C)) is flatten(2*C+B)
+    assert flatten((A*B)*C) is flatten(A*(B*C)) is ProductExpr(A, B, C)
+    assert flatten(A*(s*B)) is ProductExpr(s, A, B)
+    assert flatten(A - A) == NullExpr()
+    assert flatten(Tr(2*A) + Tr(A)) is flatten(3*Tr(A))
+
+
+def test_flatten_and_unflatten_keep_the_value():
+    C = Variable("C")
+    s = ScalarVariable("s")
+    const_dict = constants()
+    const_dict["C"] = np.random.RandomState(2).randn(3, 3)
+    const_dict["s"] = 0.5
+    x = point()
+    for expr in [(A+B)-(A-2*C), Y-D*X, (A*X)*(s*B) - X.T*(2*C), Tr(A*X*B) - 2*Tr(C)]:
+        value = expr.eval(x, X, const_dict)
+        flat = flatten(expr)
+        np.testing.assert_allclose(flat.eval(x, X, const_dict), value)
+        np.testing.assert_allclose(unflatten(flat).eval(x, X, const_dict), value)
+        assert not unflatten(flat).contains(SumExpr)
+        assert not unflatten(flat).contains(ProductExpr)
+
+
+def test_d_of_flattened_expressions():
+    expr = flatten(Tr((Y-D*X).T*(Y-D*X)))
+    const_dict = constants()
+    x = point()
+    # d(X) is set to a direction v.
+    v = np.random.RandomState(2).randn(3, 3)
+    direction_dict = dict(const_dict, **{str(DifferentialExpr(X, X)): v})
+    np.testing.assert_allclose(
+        d(expr, X).make_dx_constant(X).eval(x, X, direction_dict),
+        d(unflatten(expr), X).make_dx_constant(X).eval(x, X, direction_dict))
+    dexpr = massage2canonical(d(unflatten(expr), X), verbose=False)
+    np.testing.assert_allclose(dexpr.eval(x, X, const_dict, is_grad=True).T,
+                               numerical_gradient(expr, x, X, const_dict), rtol=1e-5, atol=1e-6)
+
+
+def test_verbose_canonical_form_of_a_deep_expression(capsys):
+    X = Variable("X")
+    expr = Tr(Variable("A0")*X)
+    for i in range(1, 3000):
+        expr = expr + Tr(Variable("A{}".format(i))*X)
+    dexpr = massage2canonical(d(expr, X))
+    assert dexpr.contains(DifferentialExpr)
+    assert len(str(dexpr)) > 3000
+    # Each rewrite is printed in bounded length.
+    out = capsys.readouterr().out
+    assert max(len(line) for line in out.splitlines()) < 1000
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from matrix_calculus import *
+from matrix_calculus.func import expr2func, expr2value_and_grad
+from matrix_calculus.matrix_massage import canonical_differential
+from matrix_calculus.parallel import ParallelEvaluator, parallel_eval
+
+from helpers import constants, point
+
+A = Variable("A")
+B = Variable("B")
+D = Variable("D")
+X = Variable("X")
+Y = Variable("Y")
+
+EXPRS = [
+    Tr((Y-D*X).T*(Y-D*X)),
+    A*X*B + B*X*A + X.T*A.T,
+    Tr(A*X.I) + Tr(B*X),
+]
+
+
+@pytest.mark.parametrize("expr", EXPRS)
+def test_parallel_eval_matches_eval(expr):
+    const_dict = constants(n=4)
+    x = point(4)
+    np.testing.assert_allclose(parallel_eval(expr, x, X, const_dict, workers=4),
+                               expr.eval(x, X, const_dict))
+
+
+def test_eval_exprs_shares_one_schedule():
+    const_dict = constants(n=4)
+    x = point(4)
+    outputs = [(expr, is_grad) for expr in EXPRS for is_grad in [False, True]]
+    with ParallelEvaluator(3) as evaluator:
+        values = evaluator.eval_exprs(outputs, x, X, const_dict)
+    for (expr, is_grad), value in zip(outputs, values):
+        np.testing.assert_allclose(value, expr.eval(x, X, const_dict, is_grad))
+
+
+def test_functions_with_workers():
+    expr = EXPRS[0]
+    const_dict = constants(n=4)
+    x = point(4)
+    f = expr2value_and_grad(expr, canonical_differential(expr, X), X, const_dict, workers=2)
+    y, grad = f(x)
+    expected_y, expected_grad = expr2value_and_grad(
+        expr, canonical_differential(expr, X), X, const_dict)(x)
+    np.testing.assert_allclose(y, expected_y)
+    np.testing.assert_allclose(grad, expected_grad)
+    f.close()
+    g = expr2func(expr, X, const_dict, workers=2)
+    np.testing.assert_allclose(g(x), expected_y)
+    g.close()
+    with pytest.raises(ValueError):
+        expr2func(expr, X, const_dict, workers=2, workspace=True)
+
+
+def test_close_shuts_the_pool_down():
+    expr = EXPRS[1]
+    const_dict = constants(n=4)
+    x = point(4)
+    for make in [lambda: expr2func(expr, X, const_dict, workers=2),
+                 lambda: expr2value_and_grad(Tr(expr), canonical_differential(Tr(expr), X), X,
+                                             const_dict, workers=2)]:
+        f = make()
+        f(x)
+        f.close()
+        with pytest.raises(RuntimeError):
+            f(x)
+    # Functions without a pool can be closed too.
+    f = expr2func(expr, X, const_dict)
+    f.close()
+    f(x)
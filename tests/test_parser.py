@@ -0,0 +1,48 @@
+import pytest
+
+from matrix_calculus import *
+from matrix_calculus.parser import PARSE_CACHE, from_string, parse
+
+A = Variable("A")
+B = Variable("B")
+D = Variable("D")
+X = Variable("X")
+Y = Variable("Y")
+s = ScalarVariable("s")
+
+
+@pytest.mark.parametrize("text, expr", [
+    ("Tr((Y-D*X)'*(Y-D*X))", Tr((Y-D*X).T*(Y-D*X))),
+    ("A*X.T + B", A*X.T + B),
+    ("A - B - X", A - B - X),
+    ("A*B*X", A*B*X),
+    ("X^-1*A", X.I*A),
+    ("Tr(A*X^(-1))", Tr(A*X.I)),
+    ("2*A - 0.5*X", 2*A - 0.5*X),
+    ("-A + X", -A + X),
+    ("s*A", s*A),
+])
+def test_parse(text, expr):
+    assert parse(text, scalars={"s"}) is expr
+
+
+def test_deep_nesting():
+    depth = 5000
+    assert parse("(" * depth + "A" + ")" * depth) is A
+
+
+@pytest.mark.parametrize("text", ["Tr(", "A +", "A B", "A)", "*A", ""])
+def test_syntax_errors(text):
+    with pytest.raises(ValueError):
+        parse(text)
+
+
+def test_parsed_expressions_are_cached():
+    PARSE_CACHE.clear()
+    expr = from_string("A*X")
+    assert from_string("A*X") is expr
+    assert PARSE_CACHE.hits == 1
+
+
+def test_d_of_a_string():
+    assert d("Tr(A*X)", "X") is d(Tr(A*X), X)
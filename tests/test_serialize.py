@@ -0,0 +1,49 @@
+import pytest
+
+from matrix_calculus import *
+from matrix_calculus import serialize
+
+A = Variable("A")
+X = Variable("X")
+s = ScalarVariable("s")
+
+
+@pytest.mark.parametrize("expr", [
+    A,
+    NullExpr(),
+    Scalar(2),
+    Scalar(0.5),
+    Scalar(2**70),
+    Tr(s*A*X.T),
+    StarExpr(A, "*"),
+    A.I*DifferentialExpr(X, X),
+    FactorizationExpr(A),
+    make_sum((1, -2.5), [A, X]),
+    make_product([s, A, X]),
+])
+def test_round_trip(expr):
+    assert serialize.loads(serialize.dumps(expr)) is expr
+
+
+def test_shared_subtrees_are_stored_once():
+    residual = A - X
+    small = serialize.dumps(residual)
+    shared = serialize.dumps(Tr(residual.T*residual))
+    assert len(shared) - len(small) < len(small)
+
+
+def test_deep_expression():
+    expr = A
+    for i in range(20000):
+        expr = expr + Scalar(i)
+    assert serialize.loads(serialize.dumps(expr)) is expr
+
+
+def test_rejects_other_data():
+    data = serialize.dumps(A)
+    with pytest.raises(ValueError):
+        serialize.loads(b"not an expression")
+    with pytest.raises(ValueError):
+        serialize.loads(data[:2])
+    with pytest.raises(ValueError):
+        serialize.loads(data[:3] + bytes([serialize.VERSION + 1]) + data[4:])
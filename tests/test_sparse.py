@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from matrix_calculus import *
+from matrix_calculus.func import expr2func
+from matrix_calculus.sparse import issparse
+
+from helpers import constants, point
+
+scipy_sparse = pytest.importorskip("scipy.sparse")
+
+A = Variable("A")
+B = Variable("B")
+X = Variable("X")
+
+
+def sparse_constants():
+    const_dict = constants("B", n=6)
+    const_dict["A"] = scipy_sparse.random(6, 6, density=0.3, random_state=np.random.RandomState(0),
+                                          format="csr") + 6 * scipy_sparse.identity(6, format="csr")
+    return const_dict
+
+
+def dense_constants(const_dict):
+    return dict((k, v.toarray() if issparse(v) else v) for k, v in const_dict.items())
+
+
+@pytest.mark.parametrize("expr", [
+    A*X, Tr(A*X), X.T*A.T + B, Tr(A.I*B), A.I*X - X, Tr(X*A*X.T),
+])
+def test_sparse_matches_dense(expr):
+    const_dict = sparse_constants()
+    x = point(6)
+    expected = expr.eval(x, X, dense_constants(const_dict))
+    value = expr.eval(x, X, const_dict)
+    assert not isinstance(value, np.matrix)
+    np.testing.assert_allclose(value, expected)
+    np.testing.assert_allclose(expr2func(expr, X, const_dict)(x), expected)
+
+
+def test_sparse_products_stay_sparse():
+    const_dict = sparse_constants()
+    assert issparse((A*A.T).eval(None, X, const_dict))